@@ -26,6 +26,11 @@ try:
 except ImportError:
     install_requires.append("odict==1.3.2")
 
+try:
+    from os import scandir
+except ImportError:
+    install_requires.append("scandir")
+
 from version import get_git_version
 
 setup(
@@ -11,42 +11,455 @@ only need to download files that didn't change.
 
 '''
 
-from hashedassets.rewrite import Rewriter
-from hashedassets.serializer import SERIALIZERS
-from hashedassets.map import AssetMap
+from hashedassets.rewrite import Rewriter, HASHFUN_NAMES, hash_data
+from hashedassets.serializer import SERIALIZERS, IndexedMap
+from hashedassets.map import AssetMap, scan_files
+from hashedassets.cache import HashCache
+from hashedassets.link import LINK_MODES, COMMANDS
+from hashedassets.watch import create_watcher, batches
+from hashedassets.stats import Hooks, Stats
+from hashedassets.compress import SidecarWriter, COMPRESSORS, COMPRESSOR_NAMES, DEFAULT_EXTENSIONS
+from hashedassets.garbage import GarbageCollector
+from hashedassets.shard import parse_shard, merge_maps
+from hashedassets.atomic import AtomicWriter, FSYNC_POLICIES
+from hashedassets.journal import Journal
+from hashedassets.references import ReferenceRewriter, dependency_levels
+from hashedassets.references import DEFAULT_EXTENSIONS as REFERENCE_EXTENSIONS
 
 import logging
+from contextlib import contextmanager
 from glob import glob
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 from os import remove, mkdir, makedirs, listdir, walk
+import os
 from os.path import join, exists, isdir, \
     splitext, normpath, dirname, commonprefix, \
-    split as path_split, samefile, abspath
+    split as path_split, samefile, abspath, relpath
 from re import split as re_split
-from shutil import copy2, Error as shutil_Error
+from shutil import Error as shutil_Error
 import sys
 from itertools import chain
+from time import time
+from cProfile import Profile
 
 logger = logging.getLogger("hashedassets")
 
+try:
+    # Python 2.7
+    from collections import OrderedDict  # pylint: disable=E0611
+except ImportError:
+    try:
+        # Python 2.6
+        from odict import odict as OrderedDict
+    except ImportError:
+        pass
+
 
 class AssetHasher(object):
 
-    def __init__(self, assetmap, rewritestring, map_only):
+    def __init__(self, assetmap, rewritestring, map_only, jobs=1, cache=None,
+                 link_mode='copy', single_pass=False, hooks=None, dedup=False,
+                 sidecars=None, references=None, gc=None, fsync='none',
+                 journal=None):
         self.assetmap = assetmap
         self.rewritestring = rewritestring
+        self.compiled = Rewriter.compile(rewritestring)
         self.map_only = map_only
+        self.jobs = jobs
+        self.cache = cache
+        self.link_mode = link_mode
+        self.link = LINK_MODES[link_mode]
+        self.hooks = list(hooks or [])
+        self.sidecars = None if map_only else sidecars
+        self._compressions = {}  # temporary output -> its Compression
+        self.gc = None if map_only else gc
 
-    def process_file(self, filename):
+        # outputs are written to temporary files and renamed into place
+        self.writer = AtomicWriter(fsync)
+
+        # finished files, for resuming an interrupted run
+        self.journal = journal
+
+        # references to other files are replaced by their hashed names, so
+        # the name of a file depends on the names of the files it references
+        self.references = None
+        self.content_hashfun = Rewriter.content_hashfun(rewritestring)
+        if references is not None and self.content_hashfun:
+            self.references = references
+
+        # the hash function we can compute while copying the file
+        self.single_pass_hashfun = None
+        if single_pass and not map_only:
+            self.single_pass_hashfun = Rewriter.content_hashfun(rewritestring)
+
+        # within a run, files with the same content are only written once
+        self.dedup = dedup and not map_only
+        self.dedup_hashfun = Rewriter.content_hashfun(rewritestring) or 'sha1'
+        self._sizes = None  # how many files have a certain size
+        self._digests = {}  # computed while hashing, needed for deduplication
+        self._originals = {}  # (size, digest) -> first output file
+        self._dedup_lock = Lock()
+        self._normalized = {}  # normalized path -> filename in the map
+        self.deduplicated = 0
+        self.saved_bytes = 0
+
+    def notify(self, event, *args):
+        for hook in self.hooks:
+            getattr(hook, event)(*args)
+
+    @contextmanager
+    def phase(self, name):
+        start = time()
+        try:
+            yield
+        finally:
+            self.notify('phase', name, time() - start)
+
+    def size(self, filename):
+        if not self.hooks:
+            return 0
+        return self.assetmap.stat(filename).st_size
+
+    def rewrite(self, filename):
+        '''
+        Returns the hashed filename and, in single pass mode, the name of a
+        temporary copy of the file that was written while hashing it.
+        '''
+        infile = join(self.assetmap.basedir, filename)
+
+        if self.references is not None and self.references.wants(filename):
+            result = self.rewrite_references(filename, infile)
+            if result is not None:
+                return result
+
+        # a file that still has its output most likely didn't change, so it
+        # is only hashed, instead of copying it to a temporary file in vain
+        if not self.single_pass_hashfun or self.has_output(filename):
+            if not (self.dedup and self.is_candidate(filename)):
+                return self.compiled(filename, self.assetmap.basedir), None
+
+            # we need the digest for deduplication anyway
+            digest = Rewriter.hash_file(infile, self.dedup_hashfun)
+            self._digests[filename] = digest
+            hashed_filename = self.compiled(filename, self.assetmap.basedir,
+                                            digests={self.dedup_hashfun: digest})
+            return hashed_filename, None
+
+        tmpfile, digest = self.write_output(
+            filename,
+            lambda outfile: Rewriter.hash_file(infile, self.single_pass_hashfun,
+                                               copy_to=outfile),
+            infile)
+
+        if self.dedup:
+            self._digests[filename] = digest
+
+        hashed_filename = self.compiled(filename, self.assetmap.basedir,
+                                        digests={self.single_pass_hashfun: digest})
+        return hashed_filename, tmpfile
+
+    def has_output(self, filename):
+        ''' Whether the output of ``filename`` of the previous run exists '''
+        previous = self.assetmap[filename]
+        return bool(previous) and exists(join(self.assetmap.output_dir, previous))
+
+    def hashed_name(self, filename):
+        '''
+        Returns the hashed name of the file at the normalized path
+        ``filename``, if it has been processed already.
+        '''
+        filename = self._normalized.get(filename, filename)
+        if filename not in self.assetmap:
+            return None
+        return self.assetmap[filename]
+
+    def rewrite_references(self, filename, infile):
+        '''
+        Replaces the references in ``filename`` by hashed names and writes the
+        result to a temporary file. Returns None if nothing was replaced.
+        '''
+        with open(infile, 'rb') as source:
+            content = source.read()
+
+        # the directory of the hashed file doesn't depend on its content
+        hashed_dir = dirname(self.compiled(filename, self.assetmap.basedir,
+                                           digests={self.content_hashfun: b''}))
+
+        rewritten = self.references.rewrite(filename, content, hashed_dir, self.hashed_name)
+        if rewritten == content:
+            return None
+
+        digest = hash_data(self.content_hashfun, rewritten)
+        if self.dedup:
+            self._digests[filename] = digest
+
+        hashed_filename = self.compiled(filename, self.assetmap.basedir,
+                                        digests={self.content_hashfun: digest})
+        if self.map_only:
+            return hashed_filename, None
+
+        tmpfile, _ = self.write_output(filename, lambda outfile: outfile.write(rewritten),
+                                       infile)
+
+        return hashed_filename, tmpfile
+
+    def has_references(self, filename):
+        # the hashed name of files with references also depends on other
+        # files, so it can't be cached or journaled
+        return self.references is not None and self.references.wants(filename)
+
+    def hash_file(self, filename):
+        if self.has_references(filename) or (self.cache is None and self.journal is None):
+            return self.timed_rewrite(filename)
+
+        filestat = self.assetmap.stat(filename)
+
+        if self.journal is not None:
+            hashed_filename = self.journal.get(filename, filestat)
+            if hashed_filename is not None:
+                logger.debug("Found '%s' in journal", filename)
+                self.notify('file_cached', filename)
+                return hashed_filename, None
+
+        if self.cache is None:
+            return self.timed_rewrite(filename)
+
+        infile = abspath(join(self.assetmap.basedir, filename))
+        key = (filename, infile, self.rewritestring)
+
+        hashed_filename = self.cache.get(key, filestat)
+        if hashed_filename is not None:
+            logger.debug("Found '%s' in hash cache", filename)
+            self.notify('file_cached', filename)
+            return hashed_filename, None
+
+        hashed_filename, tmpfile = self.timed_rewrite(filename)
+        self.cache.set(key, filestat, hashed_filename)
+        return hashed_filename, tmpfile
+
+    def timed_rewrite(self, filename):
+        start = time()
+        result = self.rewrite(filename)
+        if self.hooks:
+            self.notify('file_hashed', filename, time() - start, self.size(filename))
+        return result
+
+    def compression(self, filename):
+        '''
+        Returns a ``Compression`` to feed the output of ``filename`` to while
+        it's written, or None if it isn't compressed.
+        '''
+        if self.sidecars is None or not self.sidecars.wants(filename):
+            return None
+        return self.sidecars.start(self.assetmap.output_dir)
+
+    def write_output(self, filename, function, source=None):
+        '''
+        Writes the output of ``filename`` to a temporary file with
+        ``function(outfile)``, like ``AtomicWriter.write_temporary``. If the
+        output is compressed, everything written is compressed as well, and
+        the sidecars are moved into place once the output is.
+        '''
+        compression = self.compression(filename)
+        if compression is None:
+            return self.writer.write_temporary(self.assetmap.output_dir, function, source)
+
+        try:
+            tmpfile, result = self.writer.write_temporary(
+                self.assetmap.output_dir,
+                lambda outfile: function(compression.tee(outfile)),
+                source)
+        except:
+            compression.close()
+            raise
+
+        self._compressions[tmpfile] = compression
+        return tmpfile, result
+
+    def remove_temporary(self, tmpfile):
+        ''' Removes ``tmpfile`` of ``write_output`` if it wasn't moved into place '''
+        compression = self._compressions.pop(tmpfile, None)
+        if compression is not None:
+            compression.close()
+        if exists(tmpfile):
+            remove(tmpfile)
+
+    def materialize(self, filename, infile, outfile, tmpfile=None):
+        '''
+        Writes ``outfile``, from ``tmpfile`` if given. Returns the
+        ``Compression`` of its content if it was compressed while written.
+        '''
+        if tmpfile is not None:
+            self.writer.commit(tmpfile, outfile)
+            return self._compressions.pop(tmpfile, None)
+
+        # links don't read the file, copies compress the chunks they copy
+        compression = None
+        if self.link_mode == 'copy':
+            compression = self.compression(filename)
+        if compression is None:
+            self.writer.materialize(self.link, infile, outfile)
+            return None
+
+        try:
+            self.writer.materialize(compression.copy, infile, outfile)
+        except:
+            compression.close()
+            raise
+        return compression
+
+    def compress(self, filename, outfile, compression=None):
+        '''
+        Writes the compressed sidecars of ``outfile``, from ``compression``
+        if it was compressed while written, unless they are up to date
+        already.
+        '''
+        if self.sidecars is None or not self.sidecars.wants(filename):
+            return
+
+        start = time()
+        if compression is not None:
+            try:
+                written = self.sidecars.finish(compression, outfile)
+            finally:
+                compression.close()
+        elif self.sidecars.up_to_date(outfile):
+            logger.debug("Sidecars of '%s' are up to date", outfile)
+            return
+        else:
+            written = self.sidecars.write(outfile)
+        if self.hooks:
+            size = sum(os.path.getsize(sidecar) for sidecar in written)
+            self.notify('file_compressed', outfile, time() - start, size)
+
+    def remove_output(self, outfile):
+        remove(outfile)
+        logger.info("rm '%s'", outfile)
+        self.notify('file_removed', outfile)
+
+        if self.sidecars is not None:
+            self.sidecars.remove(outfile)
+
+    def is_candidate(self, filename):
+        '''
+        Whether ``filename`` might have the same content as an other file.
+        Files with a size no other file has can't.
+        '''
+        if self._sizes is None:
+            return True
+        return self._sizes.get(self.assetmap.stat(filename).st_size, 0) > 1
+
+    def content_key(self, filename):
+        if not self.is_candidate(filename):
+            return None
+
+        digest = self._digests.pop(filename, None)
+        if digest is None:
+            infile = join(self.assetmap.basedir, filename)
+            digest = Rewriter.hash_file(infile, self.dedup_hashfun)
+
+        return self.assetmap.stat(filename).st_size, digest
+
+    def create_dir(self, directory):
+        ''' Creates ``directory`` and its parents, if they don't exist yet '''
+        if isdir(directory or '.'):
+            return
+
+        logger.info("mkdir -p %s" % directory)
+        try:
+            makedirs(directory)
+        except OSError:
+            # another job might have created it in the meantime
+            if not isdir(directory):
+                raise
+
+    def store_duplicate(self, filename, infile, outfile, key):
+        '''
+        Links ``outfile`` to the output of an earlier file with the same
+        content. Returns False if there is none.
+        '''
+        with self._dedup_lock:
+            original = self._originals.get(key)
+
+        if original is None or not exists(original):
+            return False
+
+        if normpath(original) != normpath(outfile):
+            self.create_dir(dirname(outfile))
+            self.writer.materialize(LINK_MODES['hardlink'], original, outfile)
+            logger.info("ln '%s' '%s'", original, outfile)
+
+        size, _ = key
+        logger.debug("'%s' has the same content as '%s', saved %d bytes",
+                     infile, original, size)
+        with self._dedup_lock:
+            self.deduplicated += 1
+            self.saved_bytes += size
+        self.notify('file_deduplicated', filename, size)
+        return True
+
+    def process_steps(self, filename):
+        '''
+        Processes ``filename``, but yields the blocking calls it takes as
+        ``(function, args)`` instead of making them. Their results (or
+        exceptions) need to be sent back, so the calls can be made right
+        away or awaited in an executor.
+        '''
         logger.debug("Processing file '%s'", filename)
+        start = time()
 
         try:
-            hashed_filename = self.rewritestring % Rewriter(
-                filename, self.assetmap.basedir)
-        except IOError as e:
+            hashed_filename, tmpfile = yield self.hash_file, (filename,)
+        except (IOError, OSError) as e:
             logger.debug("'%s' does not exist, can't be hashed", filename, exc_info=e)
             return
 
+        previous = self.assetmap[filename]
+        try:
+            yield self.store_file, (filename, hashed_filename, tmpfile)
+        finally:
+            if tmpfile is not None:
+                self.remove_temporary(tmpfile)
+
+        yield self.record, (filename, previous)
+        self.notify('file_processed', filename, time() - start)
+
+    def process_file(self, filename):
+        steps = self.process_steps(filename)
+        try:
+            function, args = next(steps)
+            while True:
+                try:
+                    result = function(*args)
+                except Exception as e:
+                    function, args = steps.throw(e)
+                else:
+                    function, args = steps.send(result)
+        except StopIteration:
+            pass
+
+    def record(self, filename, previous):
+        '''
+        Journals the hashed name of ``filename``, unless it's the same as
+        the ``previous`` one, which the map or the journal has already.
+        '''
+        if self.journal is None or self.has_references(filename):
+            return
+
+        hashed_filename = self.assetmap[filename]
+        if hashed_filename is None or hashed_filename == previous:
+            return
+
+        try:
+            filestat = self.assetmap.stat(filename)
+        except OSError:
+            return
+
+        self.journal.append(filename, filestat, hashed_filename)
+
+    def store_file(self, filename, hashed_filename, tmpfile=None):
         logger.debug("Determined new hashed filename: '%s'", hashed_filename)
 
         if self.assetmap[filename]:
@@ -61,18 +474,23 @@ class AssetHasher(object):
                 if hashed_filename == self.assetmap[filename]:
                     # skip file
                     logger.debug("Skipping file '%s' -> '%s'", filename, self.assetmap[filename])
+                    self.notify('file_skipped', filename)
+                    self.compress(filename, outfile)
                     return
 
-                # remove dangling file
-                if not self.map_only:
-                    remove(outfile)
-                    logger.info("rm '%s'", outfile)
+                # remove dangling file, unless the garbage collector
+                # decides when it's no longer needed
+                if not self.map_only and self.gc is None:
+                    self.remove_output(outfile)
 
         infile = join(self.assetmap.basedir, filename).replace('/./', '/')
         outfile = join(self.assetmap.output_dir, hashed_filename).replace('/./', '/')
 
         try:
             if samefile(infile, outfile):
+                if normpath(infile) != normpath(outfile):
+                    # linked to it in a previous run
+                    self.assetmap[filename] = hashed_filename
                 logger.debug("Won't copy '%s' to itself.", filename)
                 return
         except OSError as e:
@@ -80,10 +498,20 @@ class AssetHasher(object):
                 assert False,  (dir(e), e.message, e.errno, e.strerror, e.filename)
                 raise
 
+        key = None
+        if self.dedup:
+            key = self.content_key(filename)
+            if key is not None and self.store_duplicate(filename, infile, outfile, key):
+                self.assetmap[filename] = hashed_filename
+                self.compress(filename, outfile)
+                return
+
+        start = time()
+        compression = None
         try:
             if not self.map_only:
-                copy2(infile, outfile)
-        except IOError as e:
+                compression = self.materialize(filename, infile, outfile, tmpfile)
+        except (IOError, OSError) as e:
             if e.strerror == 'Is a directory':
                 return  # nothing to copy
 
@@ -93,31 +521,419 @@ class AssetHasher(object):
             # create parent dirs that are needed for the output file
             logger.debug(hashed_filename)
             create_dir, _ = path_split(hashed_filename)
-            logger.info("mkdir -p %s" % join(self.assetmap.output_dir, create_dir))
-            makedirs(join(self.assetmap.output_dir, create_dir))
+            self.create_dir(join(self.assetmap.output_dir, create_dir))
 
             # try again
-            copy2(infile, outfile)
+            compression = self.materialize(filename, infile, outfile, tmpfile)
+
+        if key is not None:
+            with self._dedup_lock:
+                self._originals.setdefault(key, outfile)
 
         self.assetmap[filename] = hashed_filename
 
         if not self.map_only:
-            logger.info("cp '%s' '%s'", infile, outfile)
+            logger.info("%s '%s' '%s'", COMMANDS[self.link_mode], infile, outfile)
+            if self.hooks:
+                written = self.size(filename)
+                if self.link_mode in ('hardlink', 'symlink'):
+                    written = 0
+                self.notify('file_copied', filename, time() - start, written)
+
+            self.compress(filename, outfile, compression)
+
+    def process_buffer(self, filename, data):
+        '''
+        Hashes ``data`` as if it was the content of the file ``filename``
+        and writes it to the output dir, without a source file on disk.
+        ``data`` is a bytes-like object (hashed and written through the
+        buffer protocol, without copying it) or a file-like object.
+        Returns the hashed filename.
+        '''
+        start = time()
+        hashfun = self.content_hashfun
+        self.assetmap.add(filename)
+
+        tmpfile = None
+        if self.map_only:
+            digest = Rewriter.hash_buffer(data, hashfun or 'sha1')
+        else:
+            tmpfile, digest = self.write_output(
+                filename,
+                lambda outfile: Rewriter.hash_buffer(data, hashfun or 'sha1',
+                                                     copy_to=outfile))
+
+        try:
+            hashed_filename = self.compiled(filename, self.assetmap.basedir,
+                                            digests={hashfun: digest})
+            outfile = join(self.assetmap.output_dir, hashed_filename)
+
+            if self.assetmap[filename] == hashed_filename and exists(outfile):
+                logger.debug("Skipping buffer '%s' -> '%s'", filename, hashed_filename)
+                self.notify('file_skipped', filename)
+            elif tmpfile is not None:
+                if self.assetmap[filename] and self.gc is None:
+                    # remove dangling file
+                    dangling = join(self.assetmap.output_dir, self.assetmap[filename])
+                    if exists(dangling):
+                        self.remove_output(dangling)
+
+                self.create_dir(dirname(outfile))
+                compression = self.materialize(filename, None, outfile, tmpfile)
+                logger.info("write '%s' '%s'", filename, outfile)
+                self.compress(filename, outfile, compression)
+        finally:
+            if tmpfile is not None:
+                self.remove_temporary(tmpfile)
+
+        self.assetmap[filename] = hashed_filename
+        self.notify('file_processed', filename, time() - start)
+        return hashed_filename
+
+    def count_sizes(self):
+        self._sizes = {}
+
+        for filename in self.assetmap:
+            try:
+                size = self.assetmap.stat(filename).st_size
+            except OSError:
+                continue
+            self._sizes[size] = self._sizes.get(size, 0) + 1
+
+    def dependencies(self):
+        '''
+        Returns which files every file of the map references.
+        '''
+        self._normalized = dict((normpath(filename), filename) for filename in self.assetmap)
+        dependencies = OrderedDict()
+
+        for filename in self.assetmap:
+            dependencies[filename] = []
+            if not self.references.wants(filename):
+                continue
+
+            try:
+                with open(join(self.assetmap.basedir, filename), 'rb') as infile:
+                    content = infile.read()
+            except (IOError, OSError):
+                continue
+
+            dependencies[filename] = [
+                self._normalized.get(target, target)
+                for target in self.references.references(filename, content)]
+
+        return dependencies
+
+    def levels(self):
+        '''
+        Returns lists of files. The files of a list can be processed in
+        parallel, once the files of the lists before it are done.
+        '''
+        if self.references is None:
+            return [list(self.assetmap)]
+        return dependency_levels(self.dependencies())
+
+    @contextmanager
+    def processing(self):
+        ''' Processing all files of the map happens within this '''
+        if self.dedup:
+            self.count_sizes()
+
+        try:
+            yield
+        finally:
+            # later changes can have any size
+            self._sizes = None
+            self._digests.clear()
+
+        if self.deduplicated:
+            logger.info("Deduplicated %d files, saved %d bytes",
+                        self.deduplicated, self.saved_bytes)
 
     def process_all_files(self):
-        for f in self.assetmap:
-            self.process_file(f)
+        with self.processing():
+            for level in self.levels():
+                self.process_files(level)
 
-    def run(self, filename):
+    def process_files(self, filenames):
+        if self.jobs <= 1:
+            for f in filenames:
+                self.process_file(f)
+            return
+
+        # hashlib releases the GIL while hashing, so threads are enough to
+        # keep all cores busy. The map already contains every file, so the
+        # order of the entries does not depend on the order the jobs finish.
+        pool = ThreadPool(self.jobs)
+        try:
+            pool.map(self.process_file, filenames, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def remove_file(self, filename, stale):
+        '''
+        Removes ``filename`` from the map and adds its hashed name to the
+        set ``stale`` if its output might not be needed anymore.
+        '''
+        hashed_filename = self.assetmap[filename]
+        del self.assetmap[filename]
+
+        if hashed_filename and not self.map_only and self.gc is None:
+            stale.add(hashed_filename)
+
+    def remove_outputs(self, stale):
+        '''
+        Removes the outputs of the ``stale`` hashed names that no file of
+        the map has anymore.
+        '''
+        if not stale:
+            return
+
+        # files with the same content share their output
+        stale = stale.difference(target for _, target in self.assetmap.items())
+
+        for hashed_filename in sorted(stale):
+            outfile = join(self.assetmap.output_dir, hashed_filename)
+            if exists(outfile):
+                self.remove_output(outfile)
+
+    def process_changes(self, paths):
+        '''
+        Updates the map after the files or directories at ``paths`` were
+        added, modified or removed.
+        '''
+        modified = []
+        removed = []
+        stale = set()  # hashed names of removed files
+
+        for path in sorted(paths):
+            filename = relpath(path, self.assetmap.basedir)
+
+            if isdir(path):
+                if self.assetmap.excluded(join(path, '')):
+                    continue
+
+                prefix = '' if filename == '.' else join(filename, '')
+                found = set()
+                for filename, entry in scan_files(path, filename, self.assetmap.excluded):
+                    if self.assetmap.discovers(entry.path):
+                        self.assetmap.add(filename, entry)
+                        modified.append(filename)
+                        found.add(filename)
+
+                # a whole tree is reported if the watcher missed changes, its
+                # files that are gone were removed in the meantime
+                for filename in [f for f in self.assetmap
+                                 if f.startswith(prefix) and f not in found and
+                                 not exists(join(self.assetmap.basedir, f))]:
+                    self.remove_file(filename, stale)
+                    removed.append(filename)
+
+            elif exists(path):
+                if self.assetmap.discovers(path):
+                    self.assetmap.add(filename)
+                    modified.append(filename)
+
+            elif filename in self.assetmap:
+                self.remove_file(filename, stale)
+                removed.append(filename)
+
+            else:
+                # might have been a directory
+                prefix = join(filename, '')
+                for filename in [f for f in self.assetmap if f.startswith(prefix)]:
+                    self.remove_file(filename, stale)
+                    removed.append(filename)
+
+        self.process_modified(modified, removed)
+        self.remove_outputs(stale)
+        self._digests.clear()
+
+    def process_modified(self, modified, removed):
+        '''
+        Processes the ``modified`` files and, if references are rewritten,
+        all files that reference modified or ``removed`` files.
+        '''
+        if self.references is None:
+            for filename in modified:
+                self.process_file(filename)
+            return
+
+        dependencies = self.dependencies()
+        modified = set(modified)
+        changed = set(removed)
+
+        for level in dependency_levels(dependencies):
+            level = [filename for filename in level
+                     if filename in modified or
+                     changed.intersection(dependencies[filename])]
+            self.process_files(level)
+            changed.update(level)
+
+    def watch(self, filename, watcher, debounce=0.1, diff=None):
+        '''
+        Processes all files, then keeps processing the files ``watcher``
+        reports as changed until interrupted. If ``diff`` is given, the
+        changes of every update of the map are written to it.
+        '''
+        self.run(filename)
+
+        if diff:
+            self.assetmap.write_diff(diff)
+            self.assetmap.snapshot()
+
+        for changed in batches(watcher, debounce):
+            logger.debug("Changed: %s", changed)
+            self.process_changes(changed)
+
+            # every update is a generation of its own
+            if self.gc is not None:
+                self.collect_garbage()
+
+            self.write(filename)
+
+            if diff:
+                self.assetmap.write_diff(diff)
+                self.assetmap.snapshot()
+
+    def collect_garbage(self):
+        '''
+        Removes output files that are no longer needed.
+        '''
+        for name in self.assetmap.prune():
+            logger.debug("'%s' doesn't exist anymore, removing it from the map", name)
+
+        self.gc.read()
+
+        live = set(target for _, target in self.assetmap.items() if target)
+        sources = [join(self.assetmap.basedir, filename) for filename in self.assetmap]
+        extensions = [extension for extension, _ in COMPRESSORS.values()]
+
+        # outputs of the map we read, in case they aren't known yet
+        diff = self.assetmap.diff()
+        previous = list(diff.removed.values())
+        previous.extend(old for old, _ in diff.changed.values())
+
+        for removed in self.gc.collect(self.assetmap.output_dir, live, previous,
+                                       sources, extensions):
+            self.notify('file_removed', join(self.assetmap.output_dir, removed))
+
+        self.gc.write()
+
+    def read(self, filename):
+        if self.cache is not None:
+            self.cache.read()
+        if self.sidecars is not None:
+            self.sidecars.read_state()
         self.assetmap.read(filename)
-        self.process_all_files()
-        self.assetmap.write(filename)
+
+        if self.journal is not None:
+            # the journal is newer than the map
+            for name, hashed_filename in self.journal.replay():
+                if name in self.assetmap:
+                    self.assetmap[name] = hashed_filename
+
+    def write(self, filename):
+        # the map must not refer to outputs that might not be on disk yet
+        self.writer.sync()
+        self.assetmap.write(filename, sync=self.writer.fsync != 'none')
+        if self.cache is not None:
+            self.cache.write()
+        if self.sidecars is not None:
+            self.sidecars.write_state()
+        if self.journal is not None:
+            self.journal.remove()
+
+    def run(self, filename):
+        with self.phase('read'):
+            self.read(filename)
+
+        with self.phase('process'):
+            self.process_all_files()
+
+        if self.gc is not None:
+            with self.phase('gc'):
+                self.collect_garbage()
+
+        with self.phase('write'):
+            self.write(filename)
+
+        self.notify('finished')
+
+
+def hash_buffers(buffers, output_dir, rewritestring=None, map_filename=None,
+                 map_format='json', map_name='hashedassets', map_only=False, **kwargs):
+    '''
+    Hashes the ``(filename, data)`` pairs of ``buffers`` and writes them to
+    ``output_dir``, without any source files on disk. ``data`` can be
+    bytes, a bytearray, a memoryview or a file-like object. If
+    ``map_filename`` is given, the map is read from and written to it.
+    Returns the ``AssetMap``:
+
+    >>> from tempfile import mkdtemp
+    >>> from shutil import rmtree
+    >>> output_dir = mkdtemp()
+    >>> assetmap = hash_buffers([('js/app.js', b'alert(1)')], output_dir)
+    >>> list(assetmap.items())
+    [('js/app.js', 'KYo3x9BAYDOD2BfHEywYc8P4Ifs.js')]
+    >>> open(join(output_dir, 'KYo3x9BAYDOD2BfHEywYc8P4Ifs.js')).read()
+    'alert(1)'
+
+    The map is written like by ``AssetHasher.write``, after the outputs
+    were fsync'ed if ``fsync`` asks for it:
+
+    >>> map_filename = join(output_dir, 'map.json')
+    >>> _ = hash_buffers([('css/app.css', b'')], output_dir,
+    ...                  map_filename=map_filename, fsync='batch')
+    >>> sorted(hash_buffers([], output_dir, map_filename=map_filename).items())
+    [('css/app.css', '2jmj7l5rSw0yVb_vlWAYkK_YBwk.css')]
+    >>> rmtree(output_dir)
+
+    Other keyword arguments are passed to ``AssetHasher``.
+    '''
+    if rewritestring is None:
+        rewritestring = Rewriter.compute_rewritestring()
+
+    if not map_only and not isdir(output_dir):
+        makedirs(output_dir)
+        logger.info("mkdir '%s'", output_dir)
+
+    assetmap = AssetMap([], output_dir, map_name, map_format, None, None)
+    hasher = AssetHasher(assetmap, rewritestring, map_only, **kwargs)
+
+    if map_filename:
+        hasher.read(map_filename)
+
+    for filename, data in buffers:
+        hasher.process_buffer(filename, data)
+
+    if map_filename:
+        hasher.write(map_filename)
+
+    return assetmap
+
+
+def configure_logging(verbosity):
+    if len(logger.handlers) == 0:
+        ch = logging.StreamHandler(sys.stderr)
+        logger.addHandler(ch)
+
+    log_level = {
+        0: logging.ERROR,
+        1: logging.INFO,
+        2: logging.DEBUG,
+    }.get(verbosity or 0, logging.DEBUG)
+    logger.setLevel(log_level)
 
 
 def main(args=None):
     if args == None:
         args = sys.argv[1:]
 
+    if args and args[0] == 'merge':
+        return merge(args[1:])
+
     version = open(join(dirname(__file__), 'RELEASE-VERSION')).read().strip() + \
         ' (Python %d.%d.%d)' % sys.version_info[0:3]
 
@@ -171,10 +987,12 @@ def main(args=None):
     parser.add_option(
         "-d",
         "--digest",
-        choices=('sha1', 'md5'),
+        choices=HASHFUN_NAMES,
         default='sha1',
         dest="hashfun",
-        help="hash function to use. One of sha1, md5 [default: %default]",
+        help=("hash function to use. One of "
+              + ", ".join(HASHFUN_NAMES)
+              + " [default: %default]"),
         metavar="HASHFUN",
         type="choice",
     )
@@ -233,25 +1051,269 @@ def main(args=None):
         help="Excludes these files in the input directory",
     )
 
+    parser.add_option(
+        "--diff",
+        dest="diff",
+        default=None,
+        type="string",
+        help=("Write the entries that were added, changed or removed since "
+              "the last run as JSON to this file. With --watch, it's "
+              "rewritten with the changes of every update"),
+        metavar="FILE",
+    )
+
+    parser.add_option(
+        "-j",
+        "--jobs",
+        default=1,
+        dest="jobs",
+        help="number of files to hash and copy in parallel [default: %default]",
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "--cache",
+        dest="cache",
+        default=None,
+        type="string",
+        help="Remember hashes of unchanged files in this file",
+        metavar="CACHEFILE",
+    )
+
+    parser.add_option(
+        "--cache-size",
+        default=100000,
+        dest="cache_size",
+        help="maximum number of files in the cache [default: %default]",
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "--clear-cache",
+        action="store_true",
+        dest="clear_cache",
+        default=False,
+        help="Forget all hashes in the cache before running",
+    )
+
+    parser.add_option(
+        "--link-mode",
+        choices=sorted(LINK_MODES.keys()),
+        default="copy",
+        dest="link_mode",
+        help=("how to create the output files. one of "
+              + ", ".join(sorted(LINK_MODES.keys()))
+              + " [default: %default]"),
+        metavar="MODE",
+        type="choice",
+    )
+
+    parser.add_option(
+        "--single-pass",
+        action="store_true",
+        dest="single_pass",
+        default=False,
+        help="Copy files while hashing them, reading them only once",
+    )
+
+    parser.add_option(
+        "-w",
+        "--watch",
+        action="store_true",
+        dest="watch",
+        default=False,
+        help="Keep running and process files as soon as they change",
+    )
+
+    parser.add_option(
+        "--debounce",
+        default=0.1,
+        dest="debounce",
+        help=("in --watch mode, wait this many seconds for more changes "
+              "before updating the map [default: %default]"),
+        metavar="SECONDS",
+        type="float",
+    )
+
+    parser.add_option(
+        "--stats",
+        choices=('human', 'json'),
+        default=None,
+        dest="stats",
+        help=("print timings and counts of the run to stderr, "
+              "either as human or json"),
+        metavar="FORMAT",
+        type="choice",
+    )
+
+    parser.add_option(
+        "--slowest",
+        default=10,
+        dest="slowest",
+        help="number of slowest files listed by --stats [default: %default]",
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "--profile",
+        dest="profile",
+        default=None,
+        type="string",
+        help="Write cProfile statistics of the run to this file",
+        metavar="FILE",
+    )
+
+    parser.add_option(
+        "--dedup",
+        action="store_true",
+        dest="dedup",
+        default=False,
+        help="Write files with the same content only once, link the others",
+    )
+
+    parser.add_option(
+        "--rewrite-references",
+        action="store_true",
+        dest="rewrite_references",
+        default=False,
+        help=("Replace references to other files in CSS, HTML and "
+              "JavaScript files by their hashed names"),
+    )
+
+    parser.add_option(
+        "--reference-extensions",
+        default=",".join(REFERENCE_EXTENSIONS),
+        dest="reference_extensions",
+        help=("comma separated extensions of files to replace references "
+              "in [default: %default]"),
+        metavar="EXTENSIONS",
+        type="string",
+    )
+
+    parser.add_option(
+        "--gc",
+        action="store_true",
+        dest="gc",
+        default=False,
+        help=("Remove output files that are no longer in the map. Which "
+              "files were written is remembered in MAPFILE.generations"),
+    )
+
+    parser.add_option(
+        "--gc-keep",
+        default=1,
+        dest="gc_keep",
+        help=("with --gc, keep the files of this many runs "
+              "[default: %default]"),
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "--gc-min-age",
+        default=0,
+        dest="gc_min_age",
+        help=("with --gc, keep files that were in use less than this many "
+              "seconds ago [default: %default]"),
+        metavar="SECONDS",
+        type="float",
+    )
+
+    parser.add_option(
+        "-z",
+        "--compress",
+        action="append",
+        choices=COMPRESSOR_NAMES,
+        dest="compress",
+        default=None,
+        help=("also write compressed copies of the output files, can be "
+              "given more than once. one of " + ", ".join(COMPRESSOR_NAMES)),
+        metavar="FORMAT",
+        type="choice",
+    )
+
+    parser.add_option(
+        "--compress-extensions",
+        default=",".join(DEFAULT_EXTENSIONS),
+        dest="compress_extensions",
+        help="comma separated extensions of files to compress [default: %default]",
+        metavar="EXTENSIONS",
+        type="string",
+    )
+
+    parser.add_option(
+        "--compress-min-ratio",
+        default=0.9,
+        dest="compress_min_ratio",
+        help=("only keep compressed copies that are at most this fraction "
+              "of the original size [default: %default]"),
+        metavar="RATIO",
+        type="float",
+    )
+
+    parser.add_option(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default='none',
+        dest="fsync",
+        help=("when to fsync written files: none, batch (all at once before "
+              "the map is written) or each [default: %default]"),
+        metavar="POLICY",
+        type="choice",
+    )
+
+    parser.add_option(
+        "--journal",
+        action="store_true",
+        default=False,
+        help=("journal finished files to MAPFILE.journal while a run is "
+              "going on, so an interrupted run can resume where it stopped. "
+              "Files modified less than %d seconds before they were hashed "
+              "are never journaled" % HashCache.RACY_SECONDS),
+    )
+
+    parser.add_option(
+        "--shard",
+        default=None,
+        dest="shard",
+        help=("only process the files of shard INDEX of COUNT and write a "
+              "partial map, see the merge command"),
+        metavar="INDEX/COUNT",
+        type="string",
+    )
+
     (options, args) = parser.parse_args(args)
 
     if options.identity:
         options.hashfun = 'identity'
         options.keep_dirs = True
 
-    if options.verbosity == None:
-        options.verbosity = 0
+    configure_logging(options.verbosity)
 
-    if len(logger.handlers) == 0:
-        ch = logging.StreamHandler(sys.stderr)
-        logger.addHandler(ch)
+    if options.jobs < 1:
+        parser.error("--jobs needs to be at least 1")
 
-    log_level = {
-        0: logging.ERROR,
-        1: logging.INFO,
-        2: logging.DEBUG,
-    }.get(options.verbosity, logging.DEBUG)
-    logger.setLevel(log_level)
+    if options.single_pass and options.link_mode != 'copy':
+        parser.error("--single-pass always copies, it can't be used with --link-mode")
+
+    if options.gc_keep < 1:
+        parser.error("--gc-keep needs to be at least 1")
+
+    if options.shard:
+        try:
+            options.shard = parse_shard(options.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+        # the other shards' files would be missing
+        for conflicting, enabled in (('--gc', options.gc),
+                                     ('--rewrite-references', options.rewrite_references),
+                                     ('--watch', options.watch)):
+            if enabled:
+                parser.error("--shard can't be used with %s" % conflicting)
 
     if len(args) < 2 and options.map_only:
         print(args)
@@ -262,6 +1324,9 @@ def main(args=None):
 
     map_filename = args[0]
 
+    if options.gc and map_filename == '-':
+        parser.error("--gc needs a MAPFILE to remember the written files")
+
     if not options.map_format and map_filename:
         options.map_format = splitext(map_filename)[1].lstrip(".")
 
@@ -280,9 +1345,109 @@ def main(args=None):
         elif not isdir(output_dir):
             parser.error("Output dir at '%s' is not a directory" % output_dir)
 
+    profiler = None
+    if options.profile:
+        profiler = Profile()
+        profiler.enable()
+
+    try:
+        hash_assets(options, map_filename, files, output_dir)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options.profile)
+
+
+def merge(args):
+    '''
+    Merges the partial maps written with --shard into one map.
+    '''
+    parser = OptionParser(
+        usage="%prog merge [ options ] MAPFILE PARTIAL [...]",
+        description="Merges the partial maps written with --shard into MAPFILE",
+    )
+
+    parser.add_option(
+        "-v",
+        "--verbose",
+        action="count",
+        dest="verbosity",
+        help="increase verbosity level",
+    )
+
+    parser.add_option(
+        "-n",
+        "--map-name",
+        default="hashedassets",
+        dest="map_name",
+        help="name of the map [default: %default]",
+        metavar="MAPNAME",
+        type="string",
+    )
+
+    parser.add_option(
+        "-t",
+        "--map-type",
+        choices=list(SERIALIZERS.keys()),
+        dest="map_format",
+        help=("type of the map. one of "
+              + ", ".join(list(SERIALIZERS.keys()))
+              + " [default: guessed from MAPFILE]"),
+        metavar="MAPTYPE",
+        type="choice",
+    )
+
+    parser.add_option(
+        "--partial-type",
+        choices=list(SERIALIZERS.keys()),
+        dest="partial_format",
+        help=("type of the partial maps. one of "
+              + ", ".join(list(SERIALIZERS.keys()))
+              + " [default: guessed from their names]"),
+        metavar="MAPTYPE",
+        type="choice",
+    )
+
+    (options, args) = parser.parse_args(args)
+
+    configure_logging(options.verbosity)
+
+    if len(args) < 2:
+        parser.error("You need to specify MAPFILE and at least one PARTIAL map")
+
+    map_filename, partials = args[0], args[1:]
+
+    if not options.map_format:
+        options.map_format = splitext(map_filename)[1].lstrip(".")
+
+    for filename, format in [(map_filename, options.map_format)] + \
+            [(partial, options.partial_format or splitext(partial)[1].lstrip("."))
+             for partial in partials]:
+        if format not in SERIALIZERS:
+            parser.error("Invalid map type of '%s': '%s'" % (filename, format))
+
+    for partial in partials:
+        if not exists(partial):
+            parser.error("Partial map '%s' does not exist" % partial)
+        if abspath(partial) == abspath(map_filename):
+            parser.error("MAPFILE can't be one of the PARTIAL maps")
+
+    try:
+        merge_maps(partials, map_filename, options.map_format,
+                   options.map_name, options.partial_format)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def hash_assets(options, map_filename, files, output_dir):
+    hooks = []
+    if options.stats:
+        hooks.append(Stats(format=options.stats, slowest=options.slowest))
+
     rewritestring = Rewriter.compute_rewritestring(options.strip_extensions,
                                                    options.digestlength, options.keep_dirs, options.hashfun)
 
+    start = time()
     assetmap = AssetMap(
         files=files,
         output_dir=output_dir,
@@ -290,9 +1455,65 @@ def main(args=None):
         format=options.map_format,
         reference=options.reference,
         excludes=options.excludes,
+        shard=options.shard,
     )
+    for hook in hooks:
+        hook.phase('discover', time() - start)
+
+    sidecars = None
+    if options.compress:
+        sidecars = SidecarWriter(options.compress,
+                                 options.compress_extensions.split(','),
+                                 options.compress_min_ratio,
+                                 None if map_filename == '-' else map_filename + '.sidecars')
+
+    gc = None
+    if options.gc:
+        gc = GarbageCollector(map_filename + '.generations',
+                              options.gc_keep, options.gc_min_age)
+
+    references = None
+    if options.rewrite_references:
+        references = ReferenceRewriter(options.reference_extensions.split(','))
+
+    journal = None
+    if options.journal and map_filename != '-':
+        journal = Journal(map_filename + '.journal', rewritestring,
+                          sync=options.fsync == 'each')
+
+    cache = None
+    if options.cache:
+        cache = HashCache(options.cache, options.cache_size)
+        if options.clear_cache:
+            # the cache is read before processing, so overwrite it with an
+            # empty one
+            cache.write()
+
+    hasher = AssetHasher(assetmap, rewritestring, options.map_only,
+                         jobs=options.jobs, cache=cache,
+                         link_mode=options.link_mode,
+                         single_pass=options.single_pass,
+                         hooks=hooks,
+                         dedup=options.dedup,
+                         sidecars=sidecars,
+                         references=references,
+                         gc=gc,
+                         fsync=options.fsync,
+                         journal=journal)
+
+    if not options.watch:
+        hasher.run(map_filename)
+        if options.diff:
+            assetmap.write_diff(options.diff)
+        return
 
-    AssetHasher(assetmap, rewritestring, options.map_only).run(map_filename)
+    watcher = create_watcher(assetmap.roots())
+    try:
+        hasher.watch(map_filename, watcher, options.debounce, options.diff)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 if __name__ == '__main__':
     main(sys.argv[1:])
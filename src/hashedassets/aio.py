@@ -0,0 +1,194 @@
+
+'''
+Runs hashedassets in an asyncio event loop (Python 3.5 and newer).
+
+Discovering, hashing and copying files blocks, so every stage is run in an
+executor and awaited; the event loop only schedules. The files are handed to
+a fixed number of workers through a bounded queue, so a huge tree doesn't
+turn into a huge number of pending futures, and an optional semaphore bounds
+how many files are processed at once. Several projects can be processed in
+the same loop, sharing one executor and one semaphore:
+
+>>> import asyncio
+>>> from tempfile import mkdtemp
+>>> from shutil import rmtree
+>>> from os.path import join
+>>> tmp = mkdtemp()
+>>> for project in ('one', 'two'):
+...     os.makedirs(join(tmp, project, 'input'))
+...     _ = open(join(tmp, project, 'input', 'app.js'), 'w').write(project)
+
+>>> async def build_all():
+...     semaphore = asyncio.Semaphore(4)
+...     return await asyncio.gather(*[
+...         arun([join(tmp, project, 'input')], join(tmp, project, 'output'),
+...              join(tmp, project, 'map.json'), semaphore=semaphore)
+...         for project in ('one', 'two')])
+>>> for assetmap in asyncio.run(build_all()):
+...     print(list(assetmap.items()))
+[('app.js', '_gW83NxJKAEngaXxoqd8u1OY4QY.js')]
+[('app.js', 'rXguzax3D8brmmLkT5CHP7l_sms.js')]
+>>> sorted(os.listdir(join(tmp, 'two', 'output')))
+['rXguzax3D8brmmLkT5CHP7l_sms.js']
+>>> rmtree(tmp)
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.aio")
+
+import asyncio
+import os
+from contextlib import ExitStack
+from functools import partial
+from os.path import isdir
+from time import time
+
+from hashedassets import AssetHasher
+from hashedassets.map import AssetMap
+from hashedassets.rewrite import Rewriter
+
+# tells a worker that there are no more files
+_DONE = object()
+
+
+async def call(executor, function, *args):
+    ''' Runs ``function(*args)`` in ``executor`` and returns its result '''
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, partial(function, *args))
+
+
+async def discover(files, output_dir, name='hashedassets', format='json',
+                   reference=None, excludes=None, executor=None):
+    ''' Returns the ``AssetMap`` of ``files``, scanned in ``executor`` '''
+    return await call(executor, AssetMap, files, output_dir, name, format,
+                      reference, excludes)
+
+
+class AsyncAssetHasher(object):
+    '''
+    Runs the stages of ``hasher`` in ``executor``, which defaults to the
+    executor of the loop. ``concurrency`` workers process the files, at
+    most ``queue_size`` files wait for them. If ``semaphore`` is given,
+    every file is processed while holding it.
+    '''
+
+    def __init__(self, hasher, executor=None, concurrency=4, semaphore=None,
+                 queue_size=None):
+        self.hasher = hasher
+        self.executor = executor
+        self.concurrency = max(concurrency, 1)
+        self.semaphore = semaphore
+        self.queue_size = queue_size or 2 * self.concurrency
+
+    async def call(self, function, *args):
+        return await call(self.executor, function, *args)
+
+    async def process_file(self, filename):
+        # the hasher decides what to do, the blocking calls are awaited here
+        steps = self.hasher.process_steps(filename)
+        try:
+            function, args = next(steps)
+            while True:
+                try:
+                    result = await self.call(function, *args)
+                except Exception as e:
+                    function, args = steps.throw(e)
+                else:
+                    function, args = steps.send(result)
+        except StopIteration:
+            pass
+
+    async def _work(self, queue):
+        while True:
+            filename = await queue.get()
+            if filename is _DONE:
+                return
+
+            if self.semaphore is None:
+                await self.process_file(filename)
+            else:
+                async with self.semaphore:
+                    await self.process_file(filename)
+
+    async def _produce(self, queue, filenames, workers):
+        # put() waits while the queue is full, so files are only handed out
+        # as fast as the workers finish them
+        for filename in filenames:
+            await queue.put(filename)
+        for _ in range(workers):
+            await queue.put(_DONE)
+
+    async def process_files(self, filenames):
+        if not filenames:
+            return
+
+        queue = asyncio.Queue(self.queue_size)
+        workers = [asyncio.ensure_future(self._work(queue))
+                   for _ in range(min(self.concurrency, len(filenames)))]
+        tasks = [asyncio.ensure_future(self._produce(queue, filenames, len(workers)))]
+        tasks.extend(workers)
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # if a file failed, the others are not waited for
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def process_all_files(self):
+        hasher = self.hasher
+        with ExitStack() as stack:
+            # entering stats every file for deduplication, so it mustn't
+            # block the loop
+            await self.call(stack.enter_context, hasher.processing())
+            for level in await self.call(hasher.levels):
+                await self.process_files(level)
+
+    async def run(self, filename):
+        hasher = self.hasher
+
+        with hasher.phase('read'):
+            await self.call(hasher.read, filename)
+
+        with hasher.phase('process'):
+            await self.process_all_files()
+
+        if hasher.gc is not None:
+            with hasher.phase('gc'):
+                await self.call(hasher.collect_garbage)
+
+        with hasher.phase('write'):
+            await self.call(hasher.write, filename)
+
+        hasher.notify('finished')
+
+
+async def arun(files, output_dir, map_filename, rewritestring=None,
+               map_format='json', map_name='hashedassets', reference=None,
+               excludes=None, executor=None, concurrency=4, semaphore=None,
+               **kwargs):
+    '''
+    Hashes ``files`` to ``output_dir`` and writes the map to
+    ``map_filename``, like the command line tool does. Returns the
+    ``AssetMap``. Other keyword arguments are passed to ``AssetHasher``.
+    '''
+    if rewritestring is None:
+        rewritestring = Rewriter.compute_rewritestring()
+
+    map_only = kwargs.pop('map_only', False)
+    if not map_only and not isdir(output_dir):
+        await call(executor, os.makedirs, output_dir)
+        logger.info("mkdir '%s'", output_dir)
+
+    hooks = kwargs.get('hooks') or []
+    start = time()
+    assetmap = await discover(files, output_dir, map_name, map_format,
+                              reference, excludes, executor)
+    for hook in hooks:
+        hook.phase('discover', time() - start)
+
+    hasher = AssetHasher(assetmap, rewritestring, map_only, **kwargs)
+    await AsyncAssetHasher(hasher, executor, concurrency, semaphore).run(map_filename)
+
+    return assetmap
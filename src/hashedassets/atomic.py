@@ -0,0 +1,230 @@
+
+'''
+Writes files under a temporary name in the same directory and renames them
+into place, so a killed run never leaves a truncated map or output file
+behind: readers either see the old file or the complete new one.
+
+A rename survives a killed process, but not necessarily a crash of the
+machine, unless the file and its directory are fsync'ed. ``fsync`` is one
+of ``FSYNC_POLICIES``:
+
+``none``
+    never fsync, leave it to the OS
+``batch``
+    fsync all files written so far at once, when ``sync()`` is called before
+    the map is written
+``each``
+    fsync every file as soon as it is written
+
+>>> from os.path import join
+>>> from tempfile import mkdtemp
+>>> from shutil import copy2, rmtree
+>>> tmp = mkdtemp()
+>>> mapfile = join(tmp, 'map.txt')
+>>> with atomic_write(mapfile, 'w') as outfile:
+...     _ = outfile.write('a.txt: b.txt')
+>>> open(mapfile).read()
+'a.txt: b.txt'
+
+If writing fails, the old content is kept and no temporary file is left:
+
+>>> with atomic_write(mapfile, 'w') as outfile:
+...     _ = outfile.write('half a map')
+...     raise ValueError('killed')
+Traceback (most recent call last):
+    ...
+ValueError: killed
+>>> open(mapfile).read()
+'a.txt: b.txt'
+>>> os.listdir(tmp)
+['map.txt']
+
+>>> writer = AtomicWriter('batch')
+>>> writer.materialize(copy2, mapfile, join(tmp, 'copy.txt'))
+>>> writer.pending()
+1
+>>> writer.sync()
+>>> writer.pending()
+0
+>>> tmpfile, _ = writer.write_temporary(tmp, lambda outfile: outfile.write(b'data'))
+>>> writer.commit(tmpfile, join(tmp, 'data.txt'))
+>>> sorted(os.listdir(tmp))
+['copy.txt', 'data.txt', 'map.txt']
+>>> rmtree(tmp)
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.atomic")
+
+import errno
+import os
+from binascii import hexlify
+from contextlib import contextmanager
+from os.path import basename, dirname, exists, join
+from shutil import copystat
+from threading import Lock
+
+FSYNC_POLICIES = ('none', 'batch', 'each')
+
+# replace() might not be available on old versions
+replace = getattr(os, 'replace', os.rename)
+
+
+def open_temporary(filename):
+    '''
+    Creates a new temporary file next to ``filename`` and returns a file
+    descriptor opened for writing and its name. Like any new file, it gets
+    the mode 0666 minus the umask.
+    '''
+    prefix = join(dirname(filename), '.' + basename(filename) + '-')
+    while True:
+        tmpfile = prefix + hexlify(os.urandom(6)).decode('ascii')
+        try:
+            return os.open(tmpfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666), tmpfile
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def temporary(filename):
+    ''' Creates an empty temporary file next to ``filename`` '''
+    fd, tmpfile = open_temporary(filename)
+    os.close(fd)
+    return tmpfile
+
+
+def fsync(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(directory):
+    # makes renames durable, not possible on every platform
+    try:
+        fsync(directory or '.')
+    except OSError as e:
+        logger.debug("Can't fsync directory '%s': %s", directory, e)
+
+
+@contextmanager
+def atomic_write(filename, mode='w', sync=False):
+    '''
+    Opens a temporary file that replaces ``filename`` when the block is left
+    without an error. If ``sync`` is true, the file and its directory are
+    fsync'ed.
+    '''
+    tmpfile = temporary(filename)
+    try:
+        outfile = open(tmpfile, mode)
+        try:
+            yield outfile
+            outfile.flush()
+            if sync:
+                os.fsync(outfile.fileno())
+        finally:
+            outfile.close()
+
+        if exists(filename):
+            # keep the permissions the user gave the file
+            os.chmod(tmpfile, os.stat(filename).st_mode & 0o7777)
+
+        replace(tmpfile, filename)
+    except:
+        if exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+    if sync:
+        fsync_dir(dirname(filename))
+
+
+class AtomicWriter(object):
+    '''
+    Moves output files into place, fsync'ing them according to ``fsync``.
+    Can be used from several threads at once.
+    '''
+
+    def __init__(self, fsync='none'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy '%s'" % fsync)
+        self.fsync = fsync
+        self._pending = []  # written, but not fsync'ed yet
+        self._lock = Lock()
+
+    def commit(self, tmpfile, outfile):
+        ''' Replaces ``outfile`` by the finished ``tmpfile`` '''
+        if self.fsync == 'each':
+            fsync(tmpfile)
+
+        replace(tmpfile, outfile)
+
+        if self.fsync == 'each':
+            fsync_dir(dirname(outfile))
+        elif self.fsync == 'batch':
+            with self._lock:
+                self._pending.append(outfile)
+
+    def materialize(self, function, infile, outfile):
+        '''
+        Calls ``function(infile, tmpfile)`` to write a temporary file, e.g.
+        one of the ``LINK_MODES``, and moves it to ``outfile``.
+        '''
+        tmpfile = temporary(outfile)
+        try:
+            function(infile, tmpfile)
+            self.commit(tmpfile, outfile)
+        except:
+            if os.path.lexists(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    def write_temporary(self, directory, function, source=None):
+        '''
+        Calls ``function(outfile)`` with a new temporary file in ``directory``
+        opened for writing, and copies the stat of the file ``source`` to it,
+        if given. Returns the name of the temporary file, to ``commit`` it
+        later, and the result of ``function``. The temporary file is removed
+        if writing fails.
+        '''
+        fd, tmpfile = open_temporary(join(directory, 'hashedassets'))
+        try:
+            outfile = os.fdopen(fd, 'wb')
+            try:
+                result = function(outfile)
+            finally:
+                outfile.close()
+            if source is not None:
+                copystat(source, tmpfile)
+        except:
+            os.remove(tmpfile)
+            raise
+        return tmpfile, result
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def sync(self):
+        ''' fsyncs the files written since the last call, and their directories '''
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        directories = set()
+        for outfile in pending:
+            try:
+                if not os.path.islink(outfile):
+                    fsync(outfile)
+            except OSError as e:
+                # removed again in the meantime
+                logger.debug("Can't fsync '%s': %s", outfile, e)
+            directories.add(dirname(outfile))
+
+        for directory in sorted(directories):
+            fsync_dir(directory)
+
+        if pending:
+            logger.debug("fsync'ed %d files in %d directories",
+                         len(pending), len(directories))
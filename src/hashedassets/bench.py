@@ -0,0 +1,359 @@
+
+'''
+Benchmarks the discovery, hashing, copying and map writing of hashedassets on
+synthesized trees and reports the results as JSON::
+
+    python -m hashedassets.bench --shape tiny --shape huge -o results.json
+
+Each shape describes a tree: how many files, how large each one is and how
+deeply they are nested. The defaults can be overridden with --files, --size
+and --depth.
+
+>>> report = run([('tiny', dict(files=20, size=100, depth=2))], repeat=1)
+>>> result = report['results'][0]
+>>> result['files'], result['bytes']
+(20, 2000)
+>>> sorted(result['phases'])
+['discover', 'hash', 'hash+copy', 'map']
+>>> sorted(result['phases']['map']) == sorted(SERIALIZERS)
+True
+>>> result['peak_rss_bytes'] > 0
+True
+
+Every shape is benchmarked in a process of its own, so its
+``peak_rss_bytes`` is the peak memory use of that shape alone.
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.bench")
+
+import os
+import sys
+from json import dumps
+from multiprocessing import Pool
+from optparse import OptionParser
+from os.path import join, getsize
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+try:
+    import resource
+except ImportError:
+    # not on unix
+    resource = None
+
+from hashedassets import AssetHasher
+from hashedassets.map import AssetMap
+from hashedassets.rewrite import Rewriter, HASHFUN_NAMES
+from hashedassets.serializer import SERIALIZERS
+
+# name -> how the synthesized tree looks like
+SHAPES = {
+    'tiny': dict(files=10000, size=512, depth=2),
+    'huge': dict(files=4, size=256 * 1024 * 1024, depth=0),
+    'deep': dict(files=2000, size=4096, depth=12),
+}
+
+# number of subdirectories per directory
+FANOUT = 4
+
+
+def peak_rss():
+    '''
+    Returns the maximum resident set size of this process so far in bytes,
+    or None if it's not known.
+    '''
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def synthesize(top, files, size, depth):
+    '''
+    Creates ``files`` files of ``size`` random bytes below ``top``, spread
+    over directories ``depth`` levels deep. Returns the number of bytes
+    written.
+    '''
+    written = 0
+
+    for number in range(files):
+        parts = ['d%d' % (number // FANOUT ** level % FANOUT)
+                 for level in range(depth)]
+        directory = join(top, *parts)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        outfile = open(join(directory, 'f%d.txt' % number), 'wb')
+        try:
+            remaining = size
+            while remaining > 0:
+                chunk = os.urandom(min(remaining, Rewriter.CHUNK_SIZE))
+                outfile.write(chunk)
+                remaining -= len(chunk)
+        finally:
+            outfile.close()
+
+        written += size
+
+    return written
+
+
+def measure(function, repeat, setup=None):
+    '''
+    Returns the fastest of ``repeat`` runs of ``function`` in seconds. If
+    ``setup`` is given, it's called before every run without being timed,
+    and its result is passed to ``function``.
+    '''
+    best = None
+
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time()
+        function(*args)
+        seconds = time() - start
+
+        if best is None or seconds < best:
+            best = seconds
+
+    return best
+
+
+def rates(seconds, files, size=None):
+    result = {
+        'seconds': seconds,
+        'files_per_second': files / seconds if seconds else None,
+    }
+    if size is not None:
+        result['bytes_per_second'] = size / seconds if seconds else None
+    return result
+
+
+def benchmark(workdir, files, size, depth, repeat=3, hashfun='sha1', jobs=1):
+    '''
+    Runs all phases on a tree of the given shape below ``workdir`` and
+    returns a dict of their timings.
+    '''
+    source = join(workdir, 'source')
+    output = join(workdir, 'output')
+    total = synthesize(source, files, size, depth)
+
+    rewritestring = Rewriter.compute_rewritestring(hashfun=hashfun)
+
+    def discover():
+        return AssetMap([source], output, 'bench', 'json', None, None)
+
+    phases = {}
+    phases['discover'] = rates(measure(discover, repeat), files)
+
+    assetmap = discover()
+    compiled = Rewriter.compile(rewritestring)
+
+    def hash_all():
+        for filename in assetmap:
+            compiled(filename, assetmap.basedir)
+
+    phases['hash'] = rates(measure(hash_all, repeat), files, total)
+
+    def fresh_output():
+        if os.path.isdir(output):
+            rmtree(output)
+        os.mkdir(output)
+        return AssetHasher(discover(), rewritestring, False, jobs=jobs)
+
+    def copy(hasher):
+        hasher.process_all_files()
+
+    # files are hashed again while they are copied
+    phases['hash+copy'] = rates(measure(copy, repeat, fresh_output), files, total)
+
+    hasher = fresh_output()
+    copy(hasher)
+    assetmap = hasher.assetmap
+    phases['map'] = {}
+
+    for format in sorted(SERIALIZERS):
+        assetmap.format = format
+        mapfile = join(workdir, 'map.' + format)
+        seconds = measure(lambda: assetmap.write(mapfile), repeat)
+        phases['map'][format] = rates(seconds, files)
+        phases['map'][format]['size'] = getsize(mapfile)
+
+    return {
+        'files': files,
+        'bytes': total,
+        'depth': depth,
+        'phases': phases,
+    }
+
+
+def benchmark_shape(args):
+    '''
+    Benchmarks the shape ``(name, shape, repeat, hashfun, jobs)`` in a
+    temporary directory and returns the result.
+    '''
+    name, shape, repeat, hashfun, jobs = args
+
+    workdir = mkdtemp(prefix='hashedassets-bench-')
+    try:
+        logger.info("Benchmarking %s: %s", name, shape)
+        result = benchmark(workdir, repeat=repeat, hashfun=hashfun,
+                           jobs=jobs, **shape)
+    finally:
+        rmtree(workdir)
+
+    result['shape'] = name
+    result['peak_rss_bytes'] = peak_rss()
+    return result
+
+
+def run(shapes, repeat=3, hashfun='sha1', jobs=1):
+    '''
+    Benchmarks every ``(name, shape)`` in ``shapes`` and returns the report.
+    '''
+    # the peak RSS of a process never goes down, so every shape gets a fresh
+    # process to measure its own peak
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(
+            benchmark_shape,
+            [(name, shape, repeat, hashfun, jobs) for name, shape in shapes],
+            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return {
+        'python': '%d.%d.%d' % sys.version_info[0:3],
+        'platform': sys.platform,
+        'hashfun': hashfun,
+        'jobs': jobs,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def main(args=None):
+    if args == None:
+        args = sys.argv[1:]
+
+    parser = OptionParser(
+        usage="%prog [ options ]",
+        description="Benchmarks hashedassets on synthesized trees",
+    )
+
+    parser.add_option(
+        "-s",
+        "--shape",
+        action="append",
+        choices=sorted(SHAPES.keys()),
+        dest="shapes",
+        help=("shape of the tree to benchmark, can be given more than once. "
+              "one of " + ", ".join(sorted(SHAPES.keys()))
+              + " [default: all]"),
+        metavar="SHAPE",
+        type="choice",
+    )
+
+    parser.add_option(
+        "--files",
+        default=None,
+        dest="files",
+        help="number of files in each tree",
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "--size",
+        default=None,
+        dest="size",
+        help="size of each file in bytes",
+        metavar="BYTES",
+        type="int",
+    )
+
+    parser.add_option(
+        "--depth",
+        default=None,
+        dest="depth",
+        help="number of directory levels in each tree",
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "-r",
+        "--repeat",
+        default=3,
+        dest="repeat",
+        help="run each phase this often and report the fastest [default: %default]",
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "-d",
+        "--digest",
+        choices=HASHFUN_NAMES,
+        default='sha1',
+        dest="hashfun",
+        help="hash function to use [default: %default]",
+        metavar="HASHFUN",
+        type="choice",
+    )
+
+    parser.add_option(
+        "-j",
+        "--jobs",
+        default=1,
+        dest="jobs",
+        help="number of files to hash and copy in parallel [default: %default]",
+        metavar="N",
+        type="int",
+    )
+
+    parser.add_option(
+        "-o",
+        "--output",
+        default='-',
+        dest="output",
+        help="write the JSON report to this file [default: stdout]",
+        metavar="FILE",
+        type="string",
+    )
+
+    (options, args) = parser.parse_args(args)
+
+    if args:
+        parser.error("Unexpected arguments: %s" % ' '.join(args))
+
+    if options.repeat < 1:
+        parser.error("--repeat needs to be at least 1")
+
+    shapes = []
+    for name in options.shapes or sorted(SHAPES.keys()):
+        shape = dict(SHAPES[name])
+        for key in ('files', 'size', 'depth'):
+            if getattr(options, key) is not None:
+                shape[key] = getattr(options, key)
+        shapes.append((name, shape))
+
+    report = dumps(run(shapes, options.repeat, options.hashfun, options.jobs),
+                   indent=2, sort_keys=True)
+
+    if options.output == '-':
+        print(report)
+    else:
+        outfile = open(options.output, 'w')
+        try:
+            outfile.write(report + '\n')
+        finally:
+            outfile.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
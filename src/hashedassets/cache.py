@@ -0,0 +1,147 @@
+
+import logging
+logger = logging.getLogger("hashedassets.cache")
+
+from os.path import exists
+from threading import Lock
+from time import time
+
+from hashedassets.atomic import atomic_write
+
+try:
+    from json import load, dump
+except ImportError:
+    from simplejson import load, dump
+
+try:
+    # Python 2.7
+    from collections import OrderedDict  # pylint: disable=E0611
+except ImportError:
+    try:
+        # Python 2.6
+        from odict import odict as OrderedDict
+    except ImportError:
+        pass
+
+
+def stat_signature(stat):
+    '''
+    The parts of a stat result that change whenever a file's content changes:
+
+    >>> from os import stat
+    >>> size, mtime_ns, inode = stat_signature(stat(__file__))
+    >>> size > 0 and mtime_ns > 0 and inode > 0
+    True
+    '''
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1000000000)
+    return [stat.st_size, mtime_ns, stat.st_ino]
+
+
+class HashCache(object):
+    '''
+    Remembers the hashed filename of every file, keyed by its path, the
+    rewritestring (which contains the hash function) and its stat signature,
+    so unchanged files don't need to be read again.
+
+    >>> cache = HashCache(None, max_entries=2)
+    >>> from os import stat
+    >>> old = stat('/')
+    >>> cache.set(('a', 'a', '%(relpath)s'), old, 'x')
+    >>> cache.get(('a', 'a', '%(relpath)s'), old)
+    'x'
+    >>> cache.get(('a', 'a', '%(abspath|content|md5|base64)s'), old)
+
+    The least recently used entries are evicted first:
+
+    >>> cache.set(('b', 'b', '%(relpath)s'), old, 'y')
+    >>> cache.get(('a', 'a', '%(relpath)s'), old)
+    'x'
+    >>> cache.set(('c', 'c', '%(relpath)s'), old, 'z')
+    >>> cache.get(('b', 'b', '%(relpath)s'), old)
+    >>> len(cache)
+    2
+    '''
+
+    # Files modified less than this many seconds before they were hashed are
+    # not cached, as they might still change without altering their mtime.
+    RACY_SECONDS = 2
+
+    VERSION = 1
+
+    def __init__(self, filename, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(key):
+        return '\0'.join(key)
+
+    def get(self, key, stat):
+        key = self._key(key)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            if entry[:-1] != stat_signature(stat):
+                logger.debug("Cache entry for '%s' is stale", key)
+                return None
+
+            # mark as recently used
+            self._entries[key] = entry
+
+        return entry[-1]
+
+    def set(self, key, stat, hashed_filename):
+        if stat.st_mtime > time() - self.RACY_SECONDS:
+            return
+
+        key = self._key(key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = stat_signature(stat) + [hashed_filename]
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def read(self):
+        if not self.filename or not exists(self.filename):
+            return
+
+        infile = open(self.filename)
+        try:
+            content = load(infile)
+        except ValueError:
+            logger.warning("Ignoring corrupt hash cache '%s'", self.filename)
+            return
+        finally:
+            infile.close()
+
+        if content.get('version') != self.VERSION:
+            logger.debug("Ignoring hash cache '%s' of an other version", self.filename)
+            return
+
+        for key, entry in content['entries']:
+            self._entries[key] = entry
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        logger.debug("Read %d entries from hash cache", len(self._entries))
+
+    def write(self):
+        if not self.filename:
+            return
+
+        with atomic_write(self.filename, 'w') as outfile:
+            dump({
+                'version': self.VERSION,
+                'entries': list(self._entries.items()),
+            }, outfile)
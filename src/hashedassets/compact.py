@@ -0,0 +1,251 @@
+
+'''
+An ordered mapping of relative paths to hashed paths (or None) that needs a
+lot less memory than a dict for maps with millions of entries.
+
+Every path is split into its directory, which is stored once per directory,
+and its name. The directories of the entries are kept as indexes into the
+table of directories in arrays of machine integers, the names of the hashed
+files are UTF-8 encoded into one shared buffer instead of being separate
+string objects. Looking up a path takes one dict lookup for the directory
+and one in the (small) dict of names in that directory.
+
+>>> files = CompactMap([('css/a.css', None), ('css/b.css', 'css/X.css')])
+>>> files['css/a.css'] = 'css/Y.css'
+>>> files['img/logo.png'] = None
+>>> list(files.items())
+[('css/a.css', 'css/Y.css'), ('css/b.css', 'css/X.css'), ('img/logo.png', None)]
+>>> del files['css/b.css']
+>>> 'css/b.css' in files, len(files)
+(False, 2)
+>>> list(files)
+['css/a.css', 'img/logo.png']
+>>> files.directories()
+2
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.compact")
+
+from array import array
+from os import sep
+from threading import Lock
+
+# deleted entries leave holes in the lists and replaced values unused bytes
+# in the buffer, which are removed when there are more than this many of
+# them, and at least as many as there are entries or used bytes
+MIN_HOLES = 1024
+
+if bytes is str:
+    # Python 2, names are bytes already
+
+    def _encode(name):
+        return name
+
+    _decode = _encode
+
+else:
+
+    def _encode(name):
+        # undecodable bytes in file names are kept as surrogates
+        return name.encode('utf-8', 'surrogateescape')
+
+    def _decode(data):
+        return data.decode('utf-8', 'surrogateescape')
+
+
+class CompactMap(object):
+
+    def __init__(self, items=()):
+        self._lock = Lock()
+        self.clear()
+        self.update(items)
+
+    def clear(self):
+        self._prefixes = []  # directories including their trailing sep
+        self._prefix_index = {}  # directory -> its index in _prefixes
+        self._slots = []  # per directory: name -> index of the entry
+        self._key_prefixes = array('i')  # -1 for deleted entries
+        self._key_names = []
+        self._value_prefixes = array('i')  # -1 for None
+        self._value_starts = array('L')  # where the name is in _value_data
+        self._value_lengths = array('I')
+        self._value_data = bytearray()
+        self._length = 0
+        self._garbage = 0  # bytes of _value_data that are not used anymore
+
+    def _intern(self, prefix):
+        index = self._prefix_index.get(prefix)
+        if index is None:
+            index = len(self._prefixes)
+            self._prefix_index[prefix] = index
+            self._prefixes.append(prefix)
+            self._slots.append({})
+        return index
+
+    @staticmethod
+    def _split(path):
+        # the prefix keeps the separator, so prefix + name is always path
+        head, separator, name = path.rpartition(sep)
+        return head + separator, name
+
+    def _slot(self, path):
+        return self._find(*self._split(path))
+
+    def _find(self, prefix, name):
+        index = self._prefix_index.get(prefix)
+        if index is None:
+            return None
+        return self._slots[index].get(name)
+
+    def _value(self, slot):
+        prefix = self._value_prefixes[slot]
+        if prefix < 0:
+            return None
+        start = self._value_starts[slot]
+        data = self._value_data[start:start + self._value_lengths[slot]]
+        return self._prefixes[prefix] + _decode(bytes(data))
+
+    def _store_value(self, value):
+        ''' Returns the prefix index, start and length of ``value`` '''
+        if value is None:
+            return -1, 0, 0
+        prefix, name = self._split(value)
+        data = _encode(name)
+        start = len(self._value_data)
+        self._value_data.extend(data)
+        return self._intern(prefix), start, len(data)
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, path):
+        with self._lock:
+            return self._slot(path) is not None
+
+    def __getitem__(self, path):
+        # compacting renumbers the entries, so lookups need the lock, too
+        with self._lock:
+            slot = self._slot(path)
+            if slot is None:
+                raise KeyError(path)
+            return self._value(slot)
+
+    def get(self, path, default=None):
+        with self._lock:
+            slot = self._slot(path)
+            if slot is None:
+                return default
+            return self._value(slot)
+
+    def __setitem__(self, path, value):
+        prefix, name = self._split(path)
+        with self._lock:
+            slot = self._find(prefix, name)
+            if slot is not None:
+                if self._value(slot) == value:
+                    return
+                self._garbage += self._value_lengths[slot]
+                (self._value_prefixes[slot], self._value_starts[slot],
+                 self._value_lengths[slot]) = self._store_value(value)
+                self._compact_if_needed()
+                return
+
+            self._insert(prefix, name, value)
+
+    def setdefault(self, path, value=None):
+        prefix, name = self._split(path)
+        with self._lock:
+            slot = self._find(prefix, name)
+            if slot is not None:
+                return self._value(slot)
+            self._insert(prefix, name, value)
+            return value
+
+    def _insert(self, prefix, name, value):
+        value_prefix, start, length = self._store_value(value)
+        key_prefix = self._intern(prefix)
+        self._slots[key_prefix][name] = len(self._key_names)
+        self._key_prefixes.append(key_prefix)
+        self._key_names.append(name)
+        self._value_prefixes.append(value_prefix)
+        self._value_starts.append(start)
+        self._value_lengths.append(length)
+        self._length += 1
+
+    def __delitem__(self, path):
+        with self._lock:
+            prefix, name = self._split(path)
+            index = self._prefix_index.get(prefix)
+            slot = None if index is None else self._slots[index].pop(name, None)
+            if slot is None:
+                raise KeyError(path)
+
+            self._key_prefixes[slot] = -1
+            self._key_names[slot] = None
+            self._value_prefixes[slot] = -1
+            self._garbage += self._value_lengths[slot]
+            self._length -= 1
+
+            self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        holes = len(self._key_names) - self._length
+        if (holes > MIN_HOLES and holes > self._length or
+                self._garbage > MIN_HOLES and self._garbage * 2 > len(self._value_data)):
+            self._compact()
+
+    def _compact(self):
+        keep = [slot for slot, prefix in enumerate(self._key_prefixes) if prefix >= 0]
+
+        data = bytearray()
+        starts = array('L')
+        for slot in keep:
+            start = self._value_starts[slot]
+            starts.append(len(data))
+            data.extend(self._value_data[start:start + self._value_lengths[slot]])
+
+        self._key_prefixes = array('i', [self._key_prefixes[slot] for slot in keep])
+        self._key_names = [self._key_names[slot] for slot in keep]
+        self._value_prefixes = array('i', [self._value_prefixes[slot] for slot in keep])
+        self._value_starts = starts
+        self._value_lengths = array('I', [self._value_lengths[slot] for slot in keep])
+        self._value_data = data
+        self._garbage = 0
+
+        for slots in self._slots:
+            slots.clear()
+        for slot, (prefix, name) in enumerate(zip(self._key_prefixes, self._key_names)):
+            self._slots[prefix][name] = slot
+
+    def __iter__(self):
+        prefixes = self._prefixes
+        for slot, prefix in enumerate(self._key_prefixes):
+            if prefix >= 0:
+                yield prefixes[prefix] + self._key_names[slot]
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        prefixes = self._prefixes
+        for slot, prefix in enumerate(self._key_prefixes):
+            if prefix >= 0:
+                yield prefixes[prefix] + self._key_names[slot], self._value(slot)
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def update(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        for path, value in items:
+            self[path] = value
+
+    def directories(self):
+        ''' Returns the number of distinct directories '''
+        return len(self._prefixes)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self.items()))
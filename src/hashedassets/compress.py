@@ -0,0 +1,394 @@
+
+'''
+Writes precompressed variants of the output files next to them, e.g. for
+nginx' ``gzip_static`` and ``brotli_static``. gzip is always available,
+brotli and zstd need the brotli and zstandard modules.
+
+>>> from tempfile import mkdtemp
+>>> from os.path import join, exists
+>>> from shutil import rmtree
+>>> tmp = mkdtemp()
+>>> outfile = join(tmp, 'out.css')
+>>> _ = open(outfile, 'w').write('body { color: red }\\n' * 100)
+>>> sidecars = SidecarWriter(['gzip'], filename=join(tmp, 'map.json.sidecars'))
+>>> sidecars.wants('input/style.css'), sidecars.wants('input/logo.png')
+(True, False)
+>>> sidecars.up_to_date(outfile)
+False
+>>> sidecars.write(outfile) == [outfile + '.gz']
+True
+>>> import gzip
+>>> gzip.open(outfile + '.gz').read() == open(outfile, 'rb').read()
+True
+>>> sidecars.up_to_date(outfile)
+True
+
+Sidecars that don't save enough are not kept:
+
+>>> _ = open(outfile, 'w').write('x')
+>>> sidecars.up_to_date(outfile)
+False
+>>> sidecars.write(outfile)
+[]
+>>> exists(outfile + '.gz')
+False
+
+Instead, the size they had is remembered together with the stat of the
+output, so it isn't compressed again as long as it doesn't change. The state
+file ``filename`` keeps that across runs, rather than a file in the output
+dir that would be deployed with it:
+
+>>> sidecars.up_to_date(outfile)
+True
+>>> sidecars.write_state()
+>>> sidecars = SidecarWriter(['gzip'], filename=join(tmp, 'map.json.sidecars'))
+>>> sidecars.read_state()
+>>> sidecars.up_to_date(outfile)
+True
+>>> sorted(os.listdir(tmp))
+['map.json.sidecars', 'out.css']
+>>> rmtree(tmp)
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.compress")
+
+import os
+import zlib
+from os.path import dirname, exists, getmtime, join, splitext
+from shutil import copymode, copystat
+from threading import Lock
+
+from hashedassets.atomic import atomic_write, open_temporary, replace
+from hashedassets.cache import stat_signature
+
+try:
+    from json import load, dump
+except ImportError:
+    from simplejson import load, dump
+
+# name -> (extension of the sidecar, function returning a compressor)
+# compressors have compress(data) and flush() methods, like zlib's
+COMPRESSORS = {}
+
+# names of the available compressors, in the order they're offered
+COMPRESSOR_NAMES = []
+
+DEFAULT_EXTENSIONS = ('css', 'js', 'html', 'svg', 'json', 'xml', 'txt', 'map')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def register_compressor(name, extension, factory):
+    COMPRESSORS[name] = (extension, factory)
+    COMPRESSOR_NAMES.append(name)
+
+# wbits of 16 + 15 writes a gzip header without file name and timestamp, so
+# the sidecars are reproducible
+register_compressor('gzip', '.gz', lambda: zlib.compressobj(9, zlib.DEFLATED, 16 + 15))
+
+try:
+    import brotli
+except ImportError:
+    pass
+else:
+
+    class _BrotliCompressor(object):
+        '''
+        brotli is offered if the brotli module is installed:
+
+        >>> 'brotli' in COMPRESSOR_NAMES
+        True
+        >>> compressor = _BrotliCompressor()
+        >>> compressed = compressor.compress(b'abc' * 100) + compressor.flush()
+        >>> brotli.decompress(compressed) == b'abc' * 100
+        True
+        '''
+
+        def __init__(self):
+            self._compressor = brotli.Compressor(quality=11)
+
+        def compress(self, data):
+            return self._compressor.process(data)
+
+        def flush(self):
+            return self._compressor.finish()
+
+    register_compressor('brotli', '.br', _BrotliCompressor)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+
+    def _new_zstd():
+        '''
+        zstd is offered if the zstandard module is installed:
+
+        >>> 'zstd' in COMPRESSOR_NAMES
+        True
+        >>> compressor = _new_zstd()
+        >>> compressed = compressor.compress(b'abc' * 100) + compressor.flush()
+        >>> zstandard.ZstdDecompressor().decompressobj().decompress(compressed) == b'abc' * 100
+        True
+        '''
+        return zstandard.ZstdCompressor(level=19).compressobj()
+
+    register_compressor('zstd', '.zst', _new_zstd)
+
+
+class SidecarWriter(object):
+    '''
+    Compresses output files with all ``formats`` if their extension is in
+    ``extensions``. Sidecars that are bigger than ``min_ratio`` times the
+    size of the output file are thrown away, which is remembered in the
+    state file ``filename``, if given.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, formats, extensions=DEFAULT_EXTENSIONS, min_ratio=0.9,
+                 filename=None):
+        self.formats = list(formats)
+        self.extensions = set(extension.lstrip('.').lower() for extension in extensions)
+        self.min_ratio = min_ratio
+        self.filename = filename
+        # output file -> stat signature + [{format: size of the sidecar}]
+        self._rejected = {}
+        self._lock = Lock()
+
+    def wants(self, filename):
+        return splitext(filename)[1].lstrip('.').lower() in self.extensions
+
+    def sidecars(self, outfile):
+        return [outfile + COMPRESSORS[name][0] for name in self.formats]
+
+    def rejected(self, outfile, name, stat):
+        '''
+        Whether the sidecar ``name`` of ``outfile``, which has ``stat``, was
+        thrown away for not saving enough.
+        '''
+        with self._lock:
+            entry = self._rejected.get(outfile)
+        if entry is None or entry[:-1] != stat_signature(stat):
+            return False
+
+        compressed_size = entry[-1].get(name)
+        # --compress-min-ratio might have changed since
+        return compressed_size is not None and compressed_size > stat.st_size * self.min_ratio
+
+    def up_to_date(self, outfile):
+        try:
+            stat = os.stat(outfile)
+        except OSError:
+            return False
+
+        for name in self.formats:
+            try:
+                if getmtime(outfile + COMPRESSORS[name][0]) < stat.st_mtime:
+                    return False
+            except OSError:
+                if not self.rejected(outfile, name, stat):
+                    return False
+
+        return True
+
+    def remove(self, outfile):
+        with self._lock:
+            self._rejected.pop(outfile, None)
+
+        for sidecar in self.sidecars(outfile):
+            if exists(sidecar):
+                os.remove(sidecar)
+                logger.info("rm '%s'", sidecar)
+
+    def read_state(self):
+        if not self.filename or not exists(self.filename):
+            return
+
+        infile = open(self.filename)
+        try:
+            content = load(infile)
+        except ValueError:
+            logger.warning("Ignoring corrupt sidecar state '%s'", self.filename)
+            return
+        finally:
+            infile.close()
+
+        if content.get('version') != self.VERSION:
+            logger.debug("Ignoring sidecar state '%s' of an other version", self.filename)
+            return
+
+        with self._lock:
+            self._rejected.update(content['rejected'])
+
+    def write_state(self):
+        if not self.filename:
+            return
+
+        with self._lock:
+            rejected = list(self._rejected.items())
+
+        # forget outputs that were removed or changed since
+        entries = {}
+        for outfile, entry in rejected:
+            try:
+                if entry[:-1] == stat_signature(os.stat(outfile)):
+                    entries[outfile] = entry
+            except OSError:
+                pass
+
+        with atomic_write(self.filename, 'w') as outfile:
+            dump({
+                'version': self.VERSION,
+                'rejected': entries,
+            }, outfile)
+
+    def start(self, directory):
+        ''' Returns a ``Compression`` with its temporary files in ``directory`` '''
+        return Compression(self.formats, directory)
+
+    def finish(self, compression, outfile):
+        '''
+        Moves the sidecars of ``compression``, which was fed the content of
+        ``outfile``, next to it. Returns the sidecars that were kept.
+        '''
+        size = compression.size
+        written = []
+        rejected = {}
+        for name, tmpfile, compressed_size in compression.flush():
+            sidecar = outfile + COMPRESSORS[name][0]
+            if compressed_size > size * self.min_ratio:
+                logger.debug("%s doesn't compress '%s' enough (%d of %d bytes)",
+                             name, outfile, compressed_size, size)
+                if exists(sidecar):
+                    os.remove(sidecar)
+                rejected[name] = compressed_size
+                continue
+
+            copymode(outfile, tmpfile)
+            replace(tmpfile, sidecar)
+            logger.info("%s '%s' '%s'", name, outfile, sidecar)
+            written.append(sidecar)
+
+        with self._lock:
+            self._rejected.pop(outfile, None)
+            if rejected:
+                self._rejected[outfile] = stat_signature(os.stat(outfile)) + [rejected]
+
+        return written
+
+    def write(self, outfile):
+        '''
+        Reads ``outfile`` once, feeding every compressor, and returns the
+        sidecars that were kept.
+        '''
+        compression = self.start(dirname(outfile) or '.')
+        try:
+            infile = open(outfile, 'rb')
+            try:
+                while True:
+                    chunk = infile.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    compression.write(chunk)
+            finally:
+                infile.close()
+
+            return self.finish(compression, outfile)
+        finally:
+            compression.close()
+
+
+class _Tee(object):
+
+    def __init__(self, *outfiles):
+        self.outfiles = outfiles
+
+    def write(self, data):
+        for outfile in self.outfiles:
+            outfile.write(data)
+
+
+class Compression(object):
+    '''
+    Compresses everything written to it with all ``formats`` at once, into
+    temporary files in ``directory``. An output file can be fed to it while
+    it's written, so it doesn't need to be read again to be compressed:
+
+    >>> from tempfile import mkdtemp
+    >>> from os.path import join
+    >>> from shutil import rmtree
+    >>> tmp = mkdtemp()
+    >>> sidecars = SidecarWriter(['gzip'])
+    >>> compression = sidecars.start(tmp)
+    >>> with open(join(tmp, 'out.css'), 'wb') as outfile:
+    ...     compression.tee(outfile).write(b'body { color: red }\\n' * 100)
+    >>> sidecars.finish(compression, join(tmp, 'out.css')) == [join(tmp, 'out.css.gz')]
+    True
+    >>> compression.close()
+    >>> sorted(os.listdir(tmp))
+    ['out.css', 'out.css.gz']
+    >>> rmtree(tmp)
+    '''
+
+    def __init__(self, formats, directory):
+        self.size = 0
+        self._targets = []
+        try:
+            for name in formats:
+                fd, tmpfile = open_temporary(join(directory, 'hashedassets.' + name))
+                self._targets.append([name, COMPRESSORS[name][1](), os.fdopen(fd, 'wb'), tmpfile, 0])
+        except:
+            self.close()
+            raise
+
+    def write(self, data):
+        self.size += len(data)
+        for target in self._targets:
+            compressed = target[1].compress(data)
+            target[2].write(compressed)
+            target[4] += len(compressed)
+
+    def tee(self, outfile):
+        ''' Returns a file-like object that writes to ``outfile`` and to this '''
+        return _Tee(outfile, self)
+
+    def copy(self, infile, outfile):
+        ''' Copies ``infile`` to ``outfile`` like ``shutil.copy2``, compressing it on the way '''
+        source = open(infile, 'rb')
+        try:
+            target = open(outfile, 'wb')
+            try:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    self.write(chunk)
+            finally:
+                target.close()
+        finally:
+            source.close()
+        copystat(infile, outfile)
+
+    def flush(self):
+        '''
+        Finishes the temporary files. Returns the format, name and size of
+        each of them.
+        '''
+        finished = []
+        for name, compressor, tmp, tmpfile, compressed_size in self._targets:
+            compressed = compressor.flush()
+            tmp.write(compressed)
+            tmp.close()
+            finished.append((name, tmpfile, compressed_size + len(compressed)))
+        return finished
+
+    def close(self):
+        ''' Removes the temporary files that weren't moved into place '''
+        for _, _, tmp, tmpfile, _ in self._targets:
+            tmp.close()
+            if exists(tmpfile):
+                os.remove(tmpfile)
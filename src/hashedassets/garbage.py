@@ -0,0 +1,175 @@
+
+'''
+Removes hashed output files that are no longer in the map.
+
+Every run is a generation. The state file remembers in which generation
+every output file was last in use, so only files hashedassets wrote itself
+are ever removed. Files that were in use in the last ``keep`` generations or
+less than ``min_age`` seconds ago are kept, so clients that loaded an older
+version of a page can still fetch its assets.
+
+>>> from tempfile import mkdtemp
+>>> from os.path import join, exists
+>>> from shutil import rmtree
+>>> output_dir = mkdtemp()
+>>> for name in ('old.css', 'old.css.gz', 'new.css', 'unknown.css'):
+...     open(join(output_dir, name), 'w').close()
+>>> collector = GarbageCollector(None, keep=2)
+>>> collector.collect(output_dir, set(['old.css']))
+[]
+>>> collector.collect(output_dir, set(['new.css']))
+[]
+>>> sorted(collector.collect(output_dir, set(['new.css']), sidecar_extensions=['.gz']))
+['old.css', 'old.css.gz']
+>>> sorted(os.listdir(output_dir))
+['new.css', 'unknown.css']
+>>> rmtree(output_dir)
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.garbage")
+
+import os
+from os.path import abspath, dirname, exists, join, normpath
+from time import time
+
+try:
+    from json import load, dump
+except ImportError:
+    from simplejson import load, dump
+
+from hashedassets.atomic import atomic_write
+from hashedassets.map import scan_files
+
+
+class GarbageCollector(object):
+
+    VERSION = 1
+
+    def __init__(self, filename, keep=1, min_age=0):
+        self.filename = filename
+        self.keep = max(keep, 1)
+        self.min_age = min_age
+        self.generation = 0
+        self.times = {}  # generation -> when it was created
+        self.outputs = {}  # output file -> generation it was last used in
+
+    def read(self):
+        if not self.filename or not exists(self.filename):
+            return
+
+        infile = open(self.filename)
+        try:
+            content = load(infile)
+        except ValueError:
+            logger.warning("Ignoring corrupt generations file '%s'", self.filename)
+            return
+        finally:
+            infile.close()
+
+        if content.get('version') != self.VERSION:
+            logger.debug("Ignoring generations file '%s' of an other version", self.filename)
+            return
+
+        self.generation = content['generation']
+        self.times = dict((int(generation), created)
+                          for generation, created in content['times'].items())
+        self.outputs = content['outputs']
+
+    def write(self):
+        if not self.filename:
+            return
+
+        with atomic_write(self.filename, 'w') as outfile:
+            dump({
+                'version': self.VERSION,
+                'generation': self.generation,
+                'times': self.times,
+                'outputs': self.outputs,
+            }, outfile)
+
+    def collectable(self, generation, now):
+        return (generation <= self.generation - self.keep and
+                now - self.times.get(generation, now) >= self.min_age)
+
+    def collect(self, output_dir, live, previous=(), sources=(), sidecar_extensions=()):
+        '''
+        Starts a new generation in which the files in ``live`` (relative to
+        ``output_dir``) are used, and removes the collectable files. Files of
+        ``previous`` are known outputs, even if they are not in the state
+        file yet. Files in ``sources`` are never removed. Returns the
+        removed files relative to ``output_dir``.
+        '''
+        now = time()
+
+        for output in previous:
+            if output not in self.outputs:
+                self.outputs[output] = self.generation
+                self.times.setdefault(self.generation, now)
+
+        self.generation += 1
+        self.times[self.generation] = now
+        for output in live:
+            self.outputs[output] = self.generation
+
+        doomed = set(
+            output for output, generation in self.outputs.items()
+            if output not in live and self.collectable(generation, now))
+
+        removed = []
+
+        if doomed:
+            sources = set(abspath(source) for source in sources)
+            removed = self.remove(output_dir, doomed, sources, sidecar_extensions)
+
+            for output in doomed:
+                del self.outputs[output]
+
+        used = set(self.outputs.values())
+        self.times = dict((generation, created)
+                          for generation, created in self.times.items()
+                          if generation in used or generation == self.generation)
+
+        return removed
+
+    def remove(self, output_dir, doomed, sources, sidecar_extensions):
+        # a single scan of the output dir finds the doomed files and their
+        # compressed sidecars, without stat'ing every doomed file
+        removed = []
+        directories = set()
+
+        for relative, entry in scan_files(output_dir, '.', lambda path: None):
+            output = relative
+            if output not in doomed:
+                for extension in sidecar_extensions:
+                    if relative.endswith(extension) and relative[:-len(extension)] in doomed:
+                        output = relative[:-len(extension)]
+                        break
+                else:
+                    continue
+
+            if abspath(entry.path) in sources:
+                logger.debug("Not removing '%s', it's a source file", entry.path)
+                continue
+
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.warning("Can't remove '%s': %s", entry.path, e)
+                continue
+
+            logger.info("rm '%s'", entry.path)
+            removed.append(relative)
+            directories.add(dirname(relative))
+
+        # remove directories that are empty now, deepest first
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory:
+                try:
+                    os.rmdir(join(output_dir, directory))
+                except OSError:
+                    break
+                logger.info("rmdir '%s'", normpath(join(output_dir, directory)))
+                directory = dirname(directory)
+
+        return removed
@@ -0,0 +1,183 @@
+
+'''
+A write-ahead journal of the files a run has finished, so an interrupted run
+can be resumed instead of starting over.
+
+The map is only written at the end of a run. Until then, every finished file
+is appended to the journal, together with the stat signature its source file
+had. When the next run finds a journal, it replays it into the map, and the
+files whose source didn't change since are neither hashed nor copied again.
+The journal is removed once the map is written.
+
+Like the hash cache, the journal can't tell whether a file that was modified
+less than ``HashCache.RACY_SECONDS`` before it was hashed changed again
+within the same timestamp, so such files are not journaled and are hashed
+again after an interruption.
+
+>>> from tempfile import mkdtemp
+>>> from shutil import rmtree
+>>> from os import stat
+>>> from os.path import join
+>>> tmp = mkdtemp()
+>>> source = join(tmp, 'a.txt')
+>>> _ = open(source, 'w').write('a')
+>>> os.utime(source, (0, 0))
+>>> journal = Journal(join(tmp, 'map.json.journal'), '%(basename)s')
+>>> journal.append('a.txt', stat(source), 'X.txt')
+>>> journal.close()
+
+The next run replays it:
+
+>>> journal = Journal(join(tmp, 'map.json.journal'), '%(basename)s')
+>>> journal.replay()
+[('a.txt', 'X.txt')]
+>>> journal.get('a.txt', stat(source))
+'X.txt'
+
+Entries of files that changed since are ignored:
+
+>>> _ = open(source, 'w').write('b')
+>>> journal.get('a.txt', stat(source))
+>>> journal.remove()
+>>> os.listdir(tmp)
+['a.txt']
+>>> rmtree(tmp)
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.journal")
+
+import os
+from os.path import exists
+from threading import Lock
+from time import time
+
+try:
+    from json import dumps, loads
+except ImportError:
+    from simplejson import dumps, loads
+
+from hashedassets.cache import HashCache, stat_signature
+
+
+class Journal(object):
+    '''
+    The journal ``filename`` of a run with ``rewritestring``. A journal of a
+    run with an other rewritestring is ignored. Entries are flushed as they
+    are appended, so they survive a killed process, and fsync'ed as well if
+    ``sync`` is true.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, filename, rewritestring, sync=False):
+        self.filename = filename
+        self.rewritestring = rewritestring
+        self.sync = sync
+        self._entries = {}  # filename -> stat signature + [hashed filename]
+        self._valid = 0  # bytes at the start of the file that can be kept
+        self._file = None
+        self._lock = Lock()
+
+    def header(self):
+        return {'version': self.VERSION, 'rewritestring': self.rewritestring}
+
+    def replay(self):
+        '''
+        Reads the journal and returns its ``(filename, hashed filename)``
+        entries in the order they were written.
+        '''
+        self._entries.clear()
+        self._valid = 0
+
+        if not exists(self.filename):
+            return []
+
+        infile = open(self.filename, 'rb')
+        try:
+            content = infile.read()
+        finally:
+            infile.close()
+
+        entries = []
+        position = 0
+
+        for line in content.splitlines(True):
+            if not line.endswith(b'\n'):
+                # the last line of a killed run might be incomplete
+                break
+
+            try:
+                record = loads(line.decode('utf-8'))
+            except ValueError:
+                break
+
+            if not position:
+                if record != self.header():
+                    logger.debug("Ignoring journal '%s' of an other run", self.filename)
+                    return []
+            else:
+                filename, entry = record[0], record[1:]
+                self._entries[filename] = entry
+                entries.append((filename, entry[-1]))
+
+            position += len(line)
+
+        self._valid = position
+
+        if entries:
+            logger.info("Replaying %d entries of an interrupted run from '%s'",
+                        len(entries), self.filename)
+
+        return entries
+
+    def get(self, filename, stat):
+        '''
+        Returns the hashed filename of ``filename`` if it was journaled and
+        didn't change since.
+        '''
+        entry = self._entries.get(filename)
+        if entry is None or entry[:-1] != stat_signature(stat):
+            return None
+        return entry[-1]
+
+    def _open(self):
+        if self._valid:
+            # drop an incomplete last line
+            self._file = open(self.filename, 'r+b')
+            self._file.truncate(self._valid)
+            self._file.seek(self._valid)
+        else:
+            self._file = open(self.filename, 'wb')
+            self._file.write((dumps(self.header()) + '\n').encode('utf-8'))
+
+    def append(self, filename, stat, hashed_filename):
+        if stat.st_mtime > time() - HashCache.RACY_SECONDS:
+            # it might still change without altering its stat signature
+            return
+
+        line = (dumps([filename] + stat_signature(stat) + [hashed_filename]) + '\n').encode('utf-8')
+
+        with self._lock:
+            if self._file is None:
+                self._open()
+
+            self._file.write(line)
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        ''' Removes the journal, once the map contains all its entries '''
+        self.close()
+        self._entries.clear()
+        self._valid = 0
+
+        if exists(self.filename):
+            os.remove(self.filename)
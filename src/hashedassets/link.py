@@ -0,0 +1,147 @@
+
+'''
+Ways of materializing a hashed output file from its source file.
+
+``copy`` always makes a full copy, ``hardlink`` and ``symlink`` don't copy
+anything at all. ``reflink`` asks the filesystem for a copy-on-write clone
+(btrfs, XFS, ...) and ``auto`` additionally tries an in-kernel copy before
+falling back to a regular copy. ``auto`` never links, as a link would change
+its content when the source file is modified in place.
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.link")
+
+import errno
+import os
+from os.path import abspath, dirname, lexists, relpath
+from shutil import copy2, copystat
+from stat import S_ISDIR
+
+try:
+    from fcntl import ioctl
+except ImportError:
+    # not on unix
+    ioctl = None
+
+LINK_MODES = {}
+
+# what we tell the user we did
+COMMANDS = {}
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# errors that mean "not supported here", so we fall back to copying
+UNSUPPORTED = set(getattr(errno, name) for name in (
+    'EXDEV', 'EPERM', 'EMLINK', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EOPNOTSUPP',
+    'ENOTSUP', 'EBADF', 'ETXTBSY') if hasattr(errno, name))
+
+
+def _remove_existing(outfile):
+    # unlike copy2, os.link and os.symlink refuse to overwrite files
+    if lexists(outfile):
+        os.remove(outfile)
+
+
+def copy(infile, outfile):
+    copy2(infile, outfile)
+
+LINK_MODES['copy'] = copy
+COMMANDS['copy'] = 'cp'
+
+
+def hardlink(infile, outfile):
+    _remove_existing(outfile)
+    try:
+        os.link(infile, outfile)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+        logger.debug("Can't hardlink '%s' (%s), copying instead", infile, e)
+        copy2(infile, outfile)
+
+LINK_MODES['hardlink'] = hardlink
+COMMANDS['hardlink'] = 'ln'
+
+
+def symlink(infile, outfile):
+    _remove_existing(outfile)
+    os.symlink(relpath(abspath(infile), dirname(abspath(outfile))), outfile)
+
+LINK_MODES['symlink'] = symlink
+COMMANDS['symlink'] = 'ln -s'
+
+
+def _clone(infd, outfd):
+    if ioctl is None:
+        return False
+
+    try:
+        ioctl(outfd, FICLONE, infd)
+    except (IOError, OSError) as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+        return False
+
+    return True
+
+
+def _copy_file_range(infd, outfd):
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        return False
+
+    size = os.fstat(infd).st_size
+    copied = 0
+    try:
+        while copied < size:
+            written = copy_file_range(infd, outfd, size - copied)
+            if written == 0:
+                break
+            copied += written
+    except OSError as e:
+        if e.errno not in UNSUPPORTED or copied:
+            raise
+        return False
+
+    return True
+
+
+def _copy_with(infile, outfile, strategies):
+    infd = os.open(infile, os.O_RDONLY)
+    try:
+        if S_ISDIR(os.fstat(infd).st_mode):
+            raise IOError(errno.EISDIR, os.strerror(errno.EISDIR), infile)
+
+        outfd = os.open(outfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            for strategy in strategies:
+                if strategy(infd, outfd):
+                    break
+            else:
+                strategy = None
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+    if strategy is None:
+        logger.debug("Falling back to copying '%s'", infile)
+        copy2(infile, outfile)
+    else:
+        copystat(infile, outfile)
+
+
+def reflink(infile, outfile):
+    _copy_with(infile, outfile, (_clone, ))
+
+LINK_MODES['reflink'] = reflink
+COMMANDS['reflink'] = 'cp --reflink'
+
+
+def auto(infile, outfile):
+    _copy_with(infile, outfile, (_clone, _copy_file_range))
+
+LINK_MODES['auto'] = auto
+COMMANDS['auto'] = 'cp'
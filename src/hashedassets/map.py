@@ -2,30 +2,186 @@
 import logging
 logger = logging.getLogger("hashedassets.map")
 
-from os import walk
-from glob import glob
+import os
+from os import stat, sep
+from glob import glob, has_magic
 from itertools import chain
 from os.path import join, exists, isdir, relpath, \
-    dirname, commonprefix
+    dirname, commonprefix, normpath
 
 from hashedassets.serializer import SERIALIZERS
+from hashedassets.shard import in_shard
+from hashedassets.atomic import atomic_write
+from hashedassets.compact import CompactMap
 import sys
 import fnmatch
+import re
+from collections import namedtuple
 
 try:
-    # Python 2.7
-    from collections import OrderedDict  # pylint: disable=E0611
+    from json import dump
 except ImportError:
-    try:
-        # Python 2.6
-        from odict import odict as OrderedDict
-    except ImportError:
-        pass
+    from simplejson import dump
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    from scandir import scandir
+
+
+# On Windows, scandir() returns the stat results of the files along with
+# their names, so keeping the DirEntries saves a stat() per file later on.
+# Elsewhere DirEntry.stat() needs a stat() call anyway, and a DirEntry per
+# file takes more memory than that call is worth for big trees.
+KEEP_DIRENTRIES = os.name == 'nt'
+
+
+def compile_excludes(excludes):
+    '''
+    Combines all exclude patterns into a single regular expression, so every
+    path needs to be matched only once. Patterns match everything starting
+    with them:
+
+    >>> excluded = compile_excludes(['input/*/2nd', 'input/foo.txt'])
+    >>> bool(excluded('input/subdir/2nd/baz.txt'))
+    True
+    >>> bool(excluded('input/foo.txt'))
+    True
+    >>> bool(excluded('input/bar.txt'))
+    False
+    >>> bool(compile_excludes(None)('input/bar.txt'))
+    False
+    '''
+    patterns = []
+
+    for exclude in (excludes or []):
+
+        if exclude[-1] != '*':
+            exclude += '*'
+
+        patterns.append('(?:%s)' % fnmatch.translate(exclude))
+
+    if not patterns:
+        return lambda path: None
+
+    return re.compile('|'.join(patterns)).match
+
+
+def glob_match(path, pattern):
+    '''
+    Whether ``glob(pattern)`` would find ``path``:
+
+    >>> glob_match('input/foo.txt', 'input/*.txt')
+    True
+    >>> glob_match('input/subdir/bar.txt', 'input/*.txt')
+    False
+    >>> glob_match('input/.hidden.txt', 'input/*.txt')
+    False
+    '''
+    path_parts = normpath(path).split(sep)
+    pattern_parts = normpath(pattern).split(sep)
+
+    if len(path_parts) != len(pattern_parts):
+        return False
+
+    for part, pattern_part in zip(path_parts, pattern_parts):
+        # glob doesn't match hidden files with wildcards
+        if part.startswith('.') and not pattern_part.startswith('.'):
+            return False
+
+        if not fnmatch.fnmatch(part, pattern_part):
+            return False
+
+    return True
+
+
+def scan_files(top, reltop, excluded):
+    '''
+    Yields the relative path and the ``DirEntry`` of every file below
+    ``top`` that is not excluded, in the same order as ``os.walk``. As all
+    exclude patterns match everything starting with them, directories that
+    are excluded themselves are not descended into at all.
+    '''
+    stack = [(top, reltop)]
+
+    while stack:
+        path, relative = stack.pop()
+
+        try:
+            entries = list(scandir(path))
+        except OSError as e:
+            logger.debug("Can't list '%s'", path, exc_info=e)
+            continue
+
+        subdirs = []
+
+        for entry in entries:
+            entrypath = join(path, entry.name)
+
+            if relative == '.':
+                entryrelative = entry.name
+            else:
+                entryrelative = join(relative, entry.name)
+
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                # like os.walk, don't follow symlinks to directories
+                if entry.is_symlink():
+                    continue
+
+                if excluded(join(entrypath, '')):
+                    logger.debug("exclude evicts '%s'", entrypath)
+                    continue
+
+                subdirs.append((entrypath, entryrelative))
+
+            elif excluded(entrypath):
+                logger.debug("exclude evicts '%s'", entrypath)
+
+            else:
+                yield entryrelative, entry
+
+        stack.extend(reversed(subdirs))
+
+
+def discover(files, basedir, excluded):
+    '''
+    Yields the path relative to ``basedir`` and, if known, the ``DirEntry``
+    of all files matched by the globs in ``files``. Files that were matched
+    directly come first, followed by the contents of matched directories.
+    '''
+    dirs = []
+
+    for globfile in chain.from_iterable(map(glob, files)):
+        if isdir(globfile):
+            dirs.append(globfile)
+        elif not excluded(globfile):
+            yield relpath(globfile, basedir), None
+
+    for top in dirs:
+        if excluded(join(top, '')):
+            logger.debug("exclude evicts '%s'", top)
+            continue
+
+        for relative, entry in scan_files(top, relpath(top, basedir), excluded):
+            yield relative, entry
+
+
+# what changed between the map that was read and the current one. added and
+# removed map original names to hashed names, changed maps original names to
+# (old hashed name, new hashed name)
+MapDiff = namedtuple('MapDiff', 'added changed removed')
 
 
 class AssetMap(object):
 
-    def __init__(self, files, output_dir, name, format, reference, excludes):
+    def __init__(self, files, output_dir, name, format, reference, excludes,
+                 shard=None):
         logger.debug('Incoming files: %s', files)
 
         basedir = commonprefix(files)
@@ -41,39 +197,23 @@ class AssetMap(object):
         self.output_dir = output_dir
         logger.debug('Output dir is "%s"', self.output_dir)
 
-        globfiles = list(chain.from_iterable(list(map(glob, files))))
-
-        logger.debug("Globfiles: %s", globfiles)
-
-        for file_or_dir in globfiles:
-            for walkroot, _, walkfiles in walk(file_or_dir):
-                for walkfile in walkfiles:
-                    globfiles.append(join(walkroot, walkfile))
-
-        logger.debug('Resolved globfiles: %s', globfiles)
+        self.files = files
+        self.excluded = compile_excludes(excludes)
+        self.shard = shard  # (index, count) of the files to process, or None
 
-        for exclude in (excludes or []):
+        self._files = CompactMap()
+        self._entries = {}  # DirEntries, if KEEP_DIRENTRIES
+        self._previous = CompactMap()  # the entries that were read, for diff()
+        self._undiscovered = set()  # entries that were read, but not found
 
-            if exclude[-1] is not '*':
-                exclude += '*'
+        for relative, entry in discover(files, self.basedir, self.excluded):
+            if not self.in_shard(relative):
+                continue
 
-            evicts = fnmatch.filter(globfiles, exclude)
-            logger.debug("exclude '%s' evicts => %s", exclude, evicts)
+            self._files.setdefault(relative, None)
 
-            globfiles = [globfile for globfile in globfiles if globfile not in evicts]
-
-        relative_files = [
-            r for r in [
-                relpath(globfile, self.basedir)
-                for globfile
-                in globfiles
-            ]
-            if r is not '.'
-        ]
-
-        logger.debug('Resolved relative files: %s', relative_files)
-
-        self._files = OrderedDict.fromkeys(relative_files)
+            if entry is not None and KEEP_DIRENTRIES:
+                self._entries.setdefault(relative, entry)
 
         logger.debug("Initialized map, is now %s", self._files)
 
@@ -87,12 +227,97 @@ class AssetMap(object):
         else:
             self.refdir = reference
 
+    def in_shard(self, filename):
+        return self.shard is None or in_shard(filename, *self.shard)
+
+    def discovers(self, path):
+        '''
+        Whether ``path`` would be found when discovering the files again.
+        '''
+        if self.excluded(path):
+            return False
+
+        for pattern in self.files:
+            if glob_match(path, pattern):
+                return True
+
+            # files in matched directories
+            parent = dirname(normpath(path))
+            while parent and parent != dirname(parent):
+                if glob_match(parent, pattern):
+                    return True
+                parent = dirname(parent)
+
+        return False
+
+    def roots(self):
+        '''
+        Returns the directories that contain all files that can be
+        discovered.
+        '''
+        roots = []
+
+        for pattern in self.files:
+            parts = normpath(pattern).split(sep)
+            for index, part in enumerate(parts):
+                if has_magic(part):
+                    root = sep.join(parts[:index]) or '.'
+                    break
+            else:
+                root = pattern if isdir(pattern) else (dirname(pattern) or '.')
+
+            if root not in roots:
+                roots.append(root)
+
+        return roots
+
+    def add(self, filename, entry=None):
+        '''
+        Adds a file that appeared or changed after the map was created.
+        '''
+        self._files.setdefault(filename, None)
+        self._undiscovered.discard(filename)
+
+        if entry is None or not KEEP_DIRENTRIES:
+            # its stat result would be outdated
+            self._entries.pop(filename, None)
+        else:
+            self._entries[filename] = entry
+
     def __setitem__(self, name, item):
         self._files[name] = item
 
+    def __delitem__(self, name):
+        del self._files[name]
+        self._entries.pop(name, None)
+        self._undiscovered.discard(name)
+
+    def prune(self):
+        '''
+        Removes the entries of the map that was read whose original files
+        weren't found anymore. Returns their names.
+        '''
+        pruned = [name for name in self._undiscovered if name in self._files]
+        for name in pruned:
+            del self[name]
+        return pruned
+
+    def __contains__(self, name):
+        return name in self._files
+
     def __getitem__(self, item):
         return self._files[item]
 
+    def stat(self, filename):
+        '''
+        Returns the stat result of a file, reusing the one found during
+        discovery if possible.
+        '''
+        entry = self._entries.get(filename)
+        if entry is not None:
+            return entry.stat()
+        return stat(join(self.basedir, filename))
+
     def __iter__(self):
         for file in self._files:
             yield file
@@ -107,37 +332,173 @@ class AssetMap(object):
         if not exists(filename):
             return
 
-        content = open(filename).read()
+        serializer = SERIALIZERS[self.format]
 
-        deserialized = SERIALIZERS[self.format].deserialize(content)
+        infile = open(filename, 'rb' if serializer.BINARY else 'r')
+        try:
+            content = infile.read()
+        finally:
+            infile.close()
 
-        for filename, hashed_filename in list(deserialized.items()):
-            hashed_filename = relpath(join(self.refdir, hashed_filename), self.output_dir)
-            filename = relpath(join(self.refdir, filename), self.output_dir)
-            self[filename] = hashed_filename
+        deserialized = serializer.deserialize(content)
 
-        logger.debug("Read map, is now: %s", self._files)
+        if normpath(self.refdir) == normpath(self.output_dir):
+            # paths in the map are relative to the output dir already, they
+            # only need to be normalized
+            entries = (
+                (normpath(filename), normpath(hashed_filename))
+                for filename, hashed_filename in deserialized.items())
+        else:
+            entries = (
+                (relpath(join(self.refdir, filename), self.output_dir),
+                 relpath(join(self.refdir, hashed_filename), self.output_dir))
+                for filename, hashed_filename in deserialized.items())
 
-    def write(self, filename):
-        if not filename:
-            return
+        self._previous = CompactMap()
 
-        newmap = OrderedDict()
+        for filename, hashed_filename in entries:
+            if self.shard is not None and not self.in_shard(filename):
+                # a partial map only contains the files of its shard
+                continue
 
-        for origin, target in self.items():
-            if target != None:
-                origin = relpath(join(self.output_dir, origin), self.refdir)
-                target = relpath(join(self.output_dir, target), self.refdir)
-                newmap[origin] = target
+            if filename not in self._files:
+                self._undiscovered.add(filename)
+
+            self._files[filename] = hashed_filename
+            self._previous[filename] = hashed_filename
+
+        logger.debug("Read map, is now: %s", self._files)
 
-        serialized = SERIALIZERS[self.format].serialize(newmap, self.name)
+    def diff(self):
+        '''
+        Returns a ``MapDiff`` of the entries that were added, changed or
+        removed since the map was read, e.g. to upload only new files:
+
+        >>> assetmap = AssetMap([], '.', 'map', 'json', None, None)
+        >>> assetmap._previous = {'a.css': 'X.css', 'b.css': 'Y.css', 'c.css': 'Z.css'}
+        >>> assetmap['a.css'] = 'X.css'
+        >>> assetmap['b.css'] = 'W.css'
+        >>> assetmap['d.css'] = 'V.css'
+        >>> diff = assetmap.diff()
+        >>> diff.added, diff.changed, diff.removed
+        ({'d.css': 'V.css'}, {'b.css': ('Y.css', 'W.css')}, {'c.css': 'Z.css'})
+
+        Files of the map that was read, but weren't found anymore, were
+        removed:
+
+        >>> from tempfile import mkdtemp
+        >>> from shutil import rmtree
+        >>> tmp = mkdtemp()
+        >>> for name in ('a.css', 'b.css'):
+        ...     _ = open(join(tmp, name), 'w').write(name)
+        >>> _ = open(join(tmp, 'map.txt'), 'w').write('a.css: X.css\\nb.css: Y.css\\n')
+        >>> os.remove(join(tmp, 'b.css'))
+        >>> assetmap = AssetMap([join(tmp, '*.css')], join(tmp, 'output'), 'map', 'txt', None, None)
+        >>> assetmap.read(join(tmp, 'map.txt'))
+        >>> assetmap.diff().removed
+        {'b.css': 'Y.css'}
+        >>> rmtree(tmp)
+        '''
+        added = {}
+        changed = {}
+        current = set()
+
+        for filename, hashed_filename in self.items():
+            if hashed_filename is None:
+                continue
+
+            current.add(filename)
+            previous = self._previous.get(filename)
+
+            if previous is None:
+                added[filename] = hashed_filename
+            elif previous != hashed_filename:
+                changed[filename] = (previous, hashed_filename)
+
+        # entries that were read stay in the map until they are pruned
+        removed = dict(
+            (filename, hashed_filename)
+            for filename, hashed_filename in self._previous.items()
+            if filename not in current or filename in self._undiscovered)
+
+        return MapDiff(added, changed, removed)
+
+    def write_diff(self, filename):
+        '''
+        Writes the ``diff()`` as JSON to ``filename`` ('-' for stdout), with
+        paths relative to the reference directory like the map.
+        '''
+        diff = self.diff()
+
+        if normpath(self.refdir) != normpath(self.output_dir):
+            def relative(path):
+                return relpath(join(self.output_dir, path), self.refdir)
+
+            diff = MapDiff(
+                dict((relative(origin), relative(target))
+                     for origin, target in diff.added.items()),
+                dict((relative(origin), (relative(old), relative(new)))
+                     for origin, (old, new) in diff.changed.items()),
+                dict((relative(origin), relative(target))
+                     for origin, target in diff.removed.items()))
 
         if filename == '-':
             outfile = sys.stdout
         else:
             outfile = open(filename, 'w')
 
-        outfile.write(serialized)
+        try:
+            dump(diff._asdict(), outfile, indent=2, sort_keys=True)
+            outfile.write('\n')
+        finally:
+            if filename != '-':
+                outfile.close()
+
+    def snapshot(self):
+        '''
+        Makes the next ``diff()`` relative to the current entries, e.g. to
+        write a diff after every update in watch mode.
+        '''
+        self._previous = CompactMap(
+            (filename, hashed_filename)
+            for filename, hashed_filename in self.items()
+            if hashed_filename is not None and filename not in self._undiscovered)
+
+    def write(self, filename, sync=False):
+        '''
+        Writes the map to ``filename`` ('-' for stdout). The map is written
+        to a temporary file that replaces ``filename`` when it's complete,
+        and fsync'ed if ``sync`` is true.
+        '''
+        if not filename:
+            return
 
-        if filename != '-':
-            outfile.close()
+        serializer = SERIALIZERS[self.format]
+
+        if filename == '-':
+            outfile = sys.stdout
+            if serializer.BINARY:
+                outfile = getattr(sys.stdout, 'buffer', sys.stdout)
+            serializer.dump(self.relative_items(), self.name, outfile)
+            return
+
+        with atomic_write(filename, 'wb' if serializer.BINARY else 'w', sync) as outfile:
+            serializer.dump(self.relative_items(), self.name, outfile)
+
+    def relative_items(self):
+        '''
+        Yields all processed entries with paths relative to the reference
+        directory.
+        '''
+        if normpath(self.refdir) == normpath(self.output_dir):
+            # paths in the map are relative to the output dir already
+            for origin, target in self.items():
+                if target != None:
+                    yield origin, target
+            return
+
+        for origin, target in self.items():
+            if target != None:
+                origin = relpath(join(self.output_dir, origin), self.refdir)
+                target = relpath(join(self.output_dir, target), self.refdir)
+                yield origin, target
@@ -0,0 +1,208 @@
+
+'''
+Finds and replaces references to other assets in CSS, HTML and JavaScript
+files, like ``url(...)``, ``src="..."``, ``href="..."``, ``@import`` and
+``import ... from "..."``.
+
+All kinds of references are found by a single regular expression, the
+referenced files are looked up by their normalized path, so rewriting a file
+takes one pass no matter how many files there are.
+
+>>> references = ReferenceRewriter()
+>>> css = b'@import "base.css"; body { background: url(../img/bg.png?v=1) }'
+>>> sorted(references.references('css/style.css', css))
+['css/base.css', 'img/bg.png']
+
+>>> hashed = {'css/base.css': 'css/Q1w.css', 'img/bg.png': 'img/X2y.png'}
+>>> print(references.rewrite('css/style.css', css, 'css', hashed.get).decode())
+@import "Q1w.css"; body { background: url(../img/X2y.png?v=1) }
+
+External URLs and files that aren't in the map are left alone:
+
+>>> html = b'<a href="https://example.com/"><img src="/logo.png"><img src="gone.png">'
+>>> references.rewrite('index.html', html, '', hashed.get) == html
+True
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.references")
+
+import re
+from os.path import dirname, join, normpath, relpath
+
+try:
+    # Python 2.7
+    from collections import OrderedDict  # pylint: disable=E0611
+except ImportError:
+    try:
+        # Python 2.6
+        from odict import odict as OrderedDict
+    except ImportError:
+        pass
+
+DEFAULT_EXTENSIONS = ('css', 'html', 'htm', 'js', 'mjs')
+
+REFERENCE = re.compile(br'''
+    url\(\s*(?P<q1>['"]?)(?P<url>[^'"()\s]+)(?P=q1)\s*\)
+  | @import\s+(?P<q2>['"])(?P<css_import>[^'"]+)(?P=q2)
+  | \b(?:src|href)\s*=\s*(?P<q3>['"])(?P<attribute>[^'"]+)(?P=q3)
+  | \b(?:import|from|require)\s*\(?\s*(?P<q4>['"])(?P<js_import>[^'"]+)(?P=q4)
+''', re.VERBOSE)
+
+REFERENCE_GROUPS = ('url', 'css_import', 'attribute', 'js_import')
+
+# scheme:, //host, /absolute and #fragment references can't be resolved
+EXTERNAL = re.compile(r'^(?:[a-zA-Z][a-zA-Z0-9+.-]*:|/|#)')
+
+SUFFIX = re.compile(r'[?#]')
+
+
+def split_reference(reference):
+    '''
+    Splits a reference into its path and its query or fragment:
+
+    >>> split_reference('img/bg.png?v=1#top')
+    ('img/bg.png', '?v=1#top')
+    '''
+    match = SUFFIX.search(reference)
+    if match is None:
+        return reference, ''
+    return reference[:match.start()], reference[match.start():]
+
+
+class ReferenceRewriter(object):
+
+    def __init__(self, extensions=DEFAULT_EXTENSIONS):
+        self.extensions = set(extension.lstrip('.').lower() for extension in extensions)
+
+    def wants(self, filename):
+        return filename.rsplit('.', 1)[-1].lower() in self.extensions
+
+    @staticmethod
+    def _matches(content):
+        for match in REFERENCE.finditer(content):
+            for group in REFERENCE_GROUPS:
+                if match.group(group) is not None:
+                    yield match, group
+                    break
+
+    @staticmethod
+    def resolve(filename, reference):
+        '''
+        Returns the path ``reference`` in ``filename`` points to (relative
+        to the directory the paths of the map are relative to) and its query
+        or fragment. The path is None for external references.
+        '''
+        try:
+            reference = reference.decode('utf-8')
+        except UnicodeDecodeError:
+            return None, None
+
+        if EXTERNAL.match(reference):
+            return None, None
+
+        path, suffix = split_reference(reference)
+        if not path:
+            return None, None
+
+        return normpath(join(dirname(filename), path)), suffix
+
+    def references(self, filename, content):
+        ''' Yields the paths of all files referenced in ``content`` '''
+        for match, group in self._matches(content):
+            target, _ = self.resolve(filename, match.group(group))
+            if target is not None:
+                yield target
+
+    def rewrite(self, filename, content, hashed_dir, lookup):
+        '''
+        Replaces all references in ``content`` by the hashed names returned
+        by ``lookup``, relative to ``hashed_dir``, the directory the hashed
+        version of ``filename`` is written to.
+        '''
+        parts = []
+        position = 0
+
+        for match, group in self._matches(content):
+            target, suffix = self.resolve(filename, match.group(group))
+            if target is None:
+                continue
+
+            hashed = lookup(target)
+            if hashed is None:
+                continue
+
+            replacement = relpath(hashed, hashed_dir or '.').replace('\\', '/')
+            start, end = match.span(group)
+            parts.append(content[position:start])
+            parts.append((replacement + suffix).encode('utf-8'))
+            position = end
+
+        if not parts:
+            return content
+
+        parts.append(content[position:])
+        return b''.join(parts)
+
+
+def dependency_levels(dependencies):
+    '''
+    Orders the keys of the ordered dict ``dependencies``, which maps files
+    to the files they depend on, into levels. Files only depend on files of
+    earlier levels, so all files of a level can be processed in parallel:
+
+    >>> dependency_levels(OrderedDict([
+    ...     ('index.html', ['style.css', 'logo.png']),
+    ...     ('logo.png', []),
+    ...     ('style.css', ['logo.png', 'missing.png']),
+    ... ]))
+    [['logo.png'], ['style.css'], ['index.html']]
+
+    Files that depend on each other end up in the last level, with a
+    warning:
+
+    >>> import sys
+    >>> handler = logging.StreamHandler(sys.stdout)
+    >>> logger.addHandler(handler)
+    >>> logger.propagate, level = False, logger.level
+    >>> logger.setLevel(logging.WARNING)
+    >>> dependency_levels(OrderedDict([('a.css', ['b.css']), ('b.css', ['a.css'])]))
+    Circular references between a.css, b.css, their hashes don't reflect all references
+    [['a.css', 'b.css']]
+    >>> logger.removeHandler(handler)
+    >>> logger.propagate = True
+    >>> logger.setLevel(level)
+    '''
+    position = dict((node, index) for index, node in enumerate(dependencies))
+    pending = {}
+    dependents = {}
+
+    for node, targets in dependencies.items():
+        targets = set(target for target in targets
+                      if target in dependencies and target != node)
+        pending[node] = len(targets)
+        for target in targets:
+            dependents.setdefault(target, []).append(node)
+
+    levels = []
+    level = [node for node in dependencies if not pending[node]]
+
+    while level:
+        levels.append(level)
+        ready = []
+        for node in level:
+            del pending[node]
+            for dependent in dependents.get(node, ()):
+                pending[dependent] -= 1
+                if not pending[dependent]:
+                    ready.append(dependent)
+        level = sorted(ready, key=position.get)
+
+    if pending:
+        cycle = sorted(pending, key=position.get)
+        logger.warning("Circular references between %s, their hashes don't "
+                       "reflect all references", ', '.join(cycle))
+        levels.append(cycle)
+
+    return levels
+
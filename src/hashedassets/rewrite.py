@@ -2,12 +2,15 @@
 # vim: set filencoding=utf-8
 
 from os.path import abspath, dirname, join, splitext, split as path_split
+from re import compile as re_compile
 
-from hashlib import sha1, md5  # Python 2.5
+from hashlib import sha1, md5, sha256  # Python 2.5
+import hashlib
 
 from base64 import urlsafe_b64encode as urlsafe_b64encode
 from sys import version_info
 from functools import wraps
+from operator import methodcaller
 
 
 def encodedata(fun):
@@ -32,12 +35,142 @@ if version_info[0] >= 3:
         return _urlsafe_b64encode(data).decode()
 
 
+# name -> function that takes a digest size in bytes (or None for the
+# default size) and returns a new hash object
+HASHFUNS = {}
+
+# names of the available hash functions, in the order they're offered
+HASHFUN_NAMES = []
+
+# hash functions that can compute shorter digests, and their maximum size
+DIGEST_SIZES = {}
+
+
+def register_hashfun(name, factory, max_digest_size=None):
+    HASHFUNS[name] = factory
+    HASHFUN_NAMES.append(name)
+    if max_digest_size:
+        DIGEST_SIZES[name] = max_digest_size
+
+register_hashfun('sha1', lambda size: sha1())
+register_hashfun('md5', lambda size: md5())
+register_hashfun('sha256', lambda size: sha256())
+
+if hasattr(hashlib, 'blake2b'):
+    # Python 3.6
+    register_hashfun('blake2b', lambda size: hashlib.blake2b(digest_size=size or 64), 64)
+    register_hashfun('blake2s', lambda size: hashlib.blake2s(digest_size=size or 32), 32)
+
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    if hasattr(xxhash, 'xxh3_128'):
+
+        def _new_xxh3(size):
+            '''
+            xxh3 is offered if the xxhash module is installed:
+
+            >>> 'xxh3' in HASHFUN_NAMES
+            True
+            >>> hash_data('xxh3', 'abc') == xxhash.xxh3_128(b'abc').digest()
+            True
+            '''
+            return xxhash.xxh3_128()
+
+        register_hashfun('xxh3', _new_xxh3)
+
+try:
+    from blake3 import blake3
+except ImportError:
+    pass
+else:
+
+    class _SizedBlake3(object):
+        '''
+        blake3 computes digests of any length, but only on request. It's
+        offered if the blake3 module is installed:
+
+        >>> 'blake3' in HASHFUN_NAMES
+        True
+        >>> hash_data('blake3:16', 'abc') == blake3(b'abc').digest(length=16)
+        True
+        '''
+
+        def __init__(self, size):
+            self._hash = blake3()
+            self._size = size
+
+        def update(self, data):
+            self._hash.update(data)
+
+        def digest(self):
+            return self._hash.digest(length=self._size)
+
+    register_hashfun('blake3', lambda size: _SizedBlake3(size or 32), 1024)
+
+
+def split_hashfun(name):
+    '''
+    Splits a hash function like ``blake2b:16`` into its name and digest size:
+
+    >>> split_hashfun('blake2b:16')
+    ('blake2b', 16)
+    >>> split_hashfun('sha1')
+    ('sha1', None)
+    '''
+    if ':' in name:
+        name, size = name.split(':', 1)
+        if size.isdigit():
+            return name, int(size)
+        return name, -1
+    return name, None
+
+
+def is_hashfun(name):
+    '''
+    >>> is_hashfun('md5'), is_hashfun('sha1:3'), is_hashfun('base64')
+    (True, False, False)
+    '''
+    name, size = split_hashfun(name)
+    if name not in HASHFUNS:
+        return False
+    return size is None or 0 < size <= DIGEST_SIZES.get(name, 0)
+
+
+def new_hash(name):
+    name, size = split_hashfun(name)
+    return HASHFUNS[name](size)
+
+
+def hash_data(name, data):
+    '''
+    >>> hash_data('md5', 'abc') == md5(b'abc').digest()
+    True
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode()
+
+    digest = new_hash(name)
+    digest.update(data)
+    return digest.digest()
+
+
 class Rewriter(object):
 
-    def __init__(self, relpath, basedir=None):
+    # files are fed to the hash functions in chunks of this many bytes, so
+    # hashing an asset never holds more than this in memory
+    CHUNK_SIZE = 64 * 1024
+
+    # matches the hash function that is applied to a file's content
+    CONTENT_HASHFUN = re_compile(r'\bcontent\|([\w:]+)')
+
+    def __init__(self, relpath, basedir=None, digests=None):
 
         self._relpath = relpath  # path, relative to basedir
         self._basedir = basedir or '.'
+        self._digests = digests or {}  # precomputed digests of the content
 
     def __repr__(self):
         '''
@@ -64,6 +197,12 @@ class Rewriter(object):
             head = '|'.join(splitted[:-1])
             tail = splitted[-1]
 
+            if is_hashfun(tail) and splitted[-2] == 'content' and len(splitted) > 2:
+                return self.digest(self['|'.join(splitted[:-2])], tail)
+
+            if is_hashfun(tail):
+                return hash_data(tail, self[head])
+
             item = getattr(self, tail, False)
 
             if hasattr(item, '__call__'):
@@ -84,6 +223,29 @@ class Rewriter(object):
 
         return str(item)
 
+    def digest(self, filename, hashfun):
+        '''
+        Returns the digest of a file's content, without reading it if it's
+        known already.
+        '''
+        if hashfun in self._digests:
+            return self._digests[hashfun]
+
+        # hash the file while reading it instead of reading all of it
+        return self.hash_file(filename, hashfun)
+
+    @classmethod
+    def compile(cls, rewritestring):
+        '''
+        Parses the rewritestring once, so it can be applied to many files
+        quickly:
+
+        >>> rewrite = Rewriter.compile('%(reldir)s%(relpath|md5|base64|3)s%(suffix)s')
+        >>> rewrite('path/file.txt') == '%(reldir)s%(relpath|md5|base64|3)s%(suffix)s' % Rewriter('path/file.txt')
+        True
+        '''
+        return CompiledRewrite(rewritestring)
+
     @classmethod
     def compute_rewritestring(cls, strip_extensions=False, digestlength=None, keep_dirs=False, hashfun='sha1'):
         '''
@@ -93,11 +255,22 @@ class Rewriter(object):
         '%(abspath|content|sha1|base64)s'
         >>> Rewriter.compute_rewritestring(digestlength=3)
         '%(abspath|content|sha1|base64|3)s%(suffix)s'
+
+        Hash functions that support it only compute as many bytes as are
+        needed for ``digestlength`` base64 characters:
+
+        >>> Rewriter.compute_rewritestring(digestlength=27, hashfun='blake2b')
+        '%(abspath|content|blake2b:21|base64|27)s%(suffix)s'
         '''
 
         if hashfun == 'identity':
             return '%(relpath)s'
 
+        if digestlength and hashfun in DIGEST_SIZES:
+            # base64 encodes 6 bits per character
+            size = min((digestlength * 6 + 7) // 8, DIGEST_SIZES[hashfun])
+            hashfun = '%s:%d' % (hashfun, size)
+
         initial = ['abspath', 'content', hashfun, 'base64', ]
 
         if digestlength:
@@ -113,6 +286,21 @@ class Rewriter(object):
 
         return rewritestring
 
+    @classmethod
+    def content_hashfun(cls, rewritestring):
+        '''
+        Returns the hash function the rewritestring applies to the file
+        content, if any:
+
+        >>> Rewriter.content_hashfun(Rewriter.compute_rewritestring(hashfun='md5'))
+        'md5'
+        >>> Rewriter.content_hashfun(Rewriter.compute_rewritestring(hashfun='identity'))
+        '''
+        match = cls.CONTENT_HASHFUN.search(rewritestring)
+        if match and is_hashfun(match.group(1)):
+            return match.group(1)
+        return None
+
     @staticmethod
     @encodedata
     def md5(data):
@@ -154,7 +342,78 @@ class Rewriter(object):
 
     @staticmethod
     def content(filename):
-        return open(filename, 'rb').read()
+        with open(filename, 'rb') as infile:
+            return infile.read()
+
+    @classmethod
+    def hash_file(cls, filename, hashfun, copy_to=None):
+        '''
+        Computes the same digest as ``content|<hashfun>``, but reads the file
+        in chunks of ``CHUNK_SIZE`` bytes:
+
+        >>> from tempfile import NamedTemporaryFile
+        >>> tmp = NamedTemporaryFile(suffix='.txt')
+        >>> _ = tmp.write(b'abc' * 100000); tmp.flush()
+        >>> Rewriter.hash_file(tmp.name, 'sha1') == Rewriter.sha1(b'abc' * 100000)
+        True
+        >>> rewriter = Rewriter(tmp.name, '/')
+        >>> rewriter['abspath|content|md5|base64'] == Rewriter.base64(Rewriter.md5(b'abc' * 100000))
+        True
+
+        If ``copy_to`` is given, every chunk is also written to that file, so
+        the content can be copied while it's hashed:
+
+        >>> from io import BytesIO
+        >>> copy = BytesIO()
+        >>> Rewriter.hash_file(tmp.name, 'sha1', copy_to=copy) == Rewriter.sha1(b'abc' * 100000)
+        True
+        >>> copy.getvalue() == b'abc' * 100000
+        True
+        '''
+        infile = open(filename, 'rb')
+        try:
+            return cls.hash_buffer(infile, hashfun, copy_to)
+        finally:
+            infile.close()
+
+    @classmethod
+    def hash_buffer(cls, data, hashfun, copy_to=None):
+        '''
+        Like ``hash_file``, but for data that is in memory already. Objects
+        that support the buffer protocol, like bytes, bytearrays, mmaps and
+        memoryviews, are hashed and copied without copying them in memory:
+
+        >>> Rewriter.hash_buffer(bytearray(b'abc'), 'sha1') == Rewriter.sha1(b'abc')
+        True
+        >>> Rewriter.hash_buffer(memoryview(b'xabc')[1:], 'md5') == Rewriter.md5(b'abc')
+        True
+
+        File-like objects are read in chunks:
+
+        >>> from io import BytesIO
+        >>> Rewriter.hash_buffer(BytesIO(b'abc'), 'sha1') == Rewriter.sha1(b'abc')
+        True
+        '''
+        digest = new_hash(hashfun)
+
+        if hasattr(data, 'read'):
+            chunk = data.read(cls.CHUNK_SIZE)
+            while chunk:
+                digest.update(chunk)
+                if copy_to is not None:
+                    copy_to.write(chunk)
+                chunk = data.read(cls.CHUNK_SIZE)
+            return digest.digest()
+
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            # e.g. arrays of ints, hash their bytes
+            view = view.cast('B')
+
+        digest.update(view)
+        if copy_to is not None:
+            copy_to.write(view)
+        return digest.digest()
 
     '''
     Naming conventions for path parts:
@@ -229,3 +488,126 @@ class Rewriter(object):
         'txt'
         '''
         return splitext(self._relpath)[1].lstrip('.')
+
+
+class CompiledRewrite(object):
+
+    '''
+    A rewritestring that was parsed once into literal text and a list of
+    bound stages, so formatting a file doesn't need to split keys or look up
+    attributes again. Stages that are shared between placeholders are only
+    evaluated once per file:
+
+    >>> rewrite = CompiledRewrite('%(relpath|md5|base64|3)s-%(relpath|md5|base64|5)s%%')
+    >>> rewrite('path/file')
+    '3Hc-3HcQq%'
+    >>> len(rewrite._stages)
+    5
+    >>> CompiledRewrite('%(nonexistent)s')
+    Traceback (most recent call last):
+    ...
+    KeyError: 'nonexistent not in Rewriter'
+    '''
+
+    PLACEHOLDER = re_compile(r'%\(([^)]*)\)s|%%')
+
+    def __init__(self, rewritestring):
+        self.rewritestring = rewritestring
+
+        # (index of the stage whose result is the input or None, stage),
+        # where stage takes the Rewriter and the input
+        self._stages = []
+        self._stage_indexes = {}  # prefix of a key -> index in self._stages
+
+        # literal strings and indexes of the stages that fill placeholders
+        self._parts = []
+
+        position = 0
+        for match in self.PLACEHOLDER.finditer(rewritestring):
+            self._add_literal(rewritestring[position:match.start()])
+
+            if match.group(1) is None:
+                self._add_literal('%', escaped=True)
+            else:
+                self._parts.append(self._bind(match.group(1)))
+
+            position = match.end()
+
+        self._add_literal(rewritestring[position:])
+
+    def __repr__(self):
+        return "<CompiledRewrite('%s')>" % self.rewritestring
+
+    def _add_literal(self, literal, escaped=False):
+        if '%' in literal and not escaped:
+            raise ValueError("Unsupported format in '%s'" % self.rewritestring)
+
+        if literal:
+            self._parts.append(literal)
+
+    def _add_stage(self, prefix, source, stage):
+        if prefix not in self._stage_indexes:
+            self._stage_indexes[prefix] = len(self._stages)
+            self._stages.append((source, stage))
+        return self._stage_indexes[prefix]
+
+    def _bind(self, key):
+        '''
+        Adds the stages needed to compute ``key`` and returns the index of
+        the last one.
+        '''
+        names = key.split('|')
+
+        first = names[0]
+        if not hasattr(Rewriter, first):
+            raise KeyError('%s not in Rewriter' % first)
+
+        if hasattr(getattr(Rewriter, first), '__call__'):
+            index = self._add_stage(first, None, lambda rewriter, _, method=methodcaller(first):
+                                    method(rewriter))
+        else:
+            index = self._add_stage(first, None, lambda rewriter, _: str(getattr(rewriter, first)))
+
+        source = index
+        for position, name in enumerate(names[1:], 1):
+            prefix = '|'.join(names[:position + 1])
+
+            if is_hashfun(name) and names[position - 1] == 'content' and position > 1:
+                # the 'content' stage is fused into this one, so the file is
+                # hashed while reading it instead of reading it first
+                index = self._add_stage(prefix, previous, lambda rewriter, filename, hashfun=name:
+                                        rewriter.digest(filename, hashfun))
+                source = index
+                continue
+
+            if name == 'content' and position + 1 < len(names) and is_hashfun(names[position + 1]):
+                # will be fused into the next stage
+                previous = source
+                continue
+
+            function = getattr(Rewriter, name, None)
+
+            if is_hashfun(name):
+                stage = lambda _, value, hashfun=name: hash_data(hashfun, value)
+            elif hasattr(function, '__call__'):
+                stage = lambda _, value, function=function: function(value)
+            elif name.isdigit():
+                stage = lambda _, value, length=int(name): value[:length]
+            else:
+                raise KeyError("Unable to format '%s'" % key)
+
+            previous = source
+            source = self._add_stage(prefix, source, stage)
+
+        return source
+
+    def __call__(self, relpath, basedir=None, digests=None):
+        rewriter = Rewriter(relpath, basedir, digests)
+
+        results = []
+        for source, stage in self._stages:
+            results.append(stage(rewriter, None if source is None else results[source]))
+
+        return ''.join([
+            part if isinstance(part, str) else '%s' % (results[part], )
+            for part in self._parts])
@@ -1,18 +1,54 @@
 #!/usr/bin/env python
 
+from mmap import mmap, ACCESS_READ
 from re import split as re_split
+from struct import Struct
+
+try:
+    from io import StringIO, BytesIO
+except ImportError:
+    from StringIO import StringIO
+    BytesIO = StringIO
 
 SERIALIZERS = {}
 
 
-class SimpleSerializer(object):
+class Serializer(object):
+
+    '''
+    Serializers write the entries of a map one by one with their
+    ``dump(items, map_name, outfile)`` class method, so writing a map
+    doesn't need to hold all of it in memory at once. ``serialize`` returns
+    the same as a string.
+    '''
+
+    # binary maps need to be opened in binary mode
+    BINARY = False
 
     @classmethod
-    def serialize(cls, items, _):
-        return "\n".join([
-            "%s: %s" % item
-            for item
-            in list(items.items())]) + "\n"
+    def serialize(cls, items, map_name):
+        outfile = BytesIO() if cls.BINARY else StringIO()
+        cls.dump(items.items(), map_name, outfile)
+        return outfile.getvalue()
+
+
+class SimpleSerializer(Serializer):
+
+    @classmethod
+    def dump(cls, items, _, outfile):
+        '''
+        >>> from sys import stdout
+        >>> SimpleSerializer.dump(iter([('a', 'b'), ('c', 'd')]), None, stdout)
+        a: b
+        c: d
+        '''
+        empty = True
+        for item in items:
+            outfile.write("%s: %s\n" % item)
+            empty = False
+
+        if empty:
+            outfile.write("\n")
 
     @classmethod
     def deserialize(cls, string):
@@ -36,11 +72,38 @@ except ImportError:
 
 if loads and dumps:
 
-    class JSONSerializer(object):
+    def dump_json_object(items, outfile):
+        '''
+        Writes the same as ``dumps(dict(items), sort_keys=True, indent=2)``
+        without building the whole string:
+
+        >>> from sys import stdout
+        >>> dump_json_object([('b', '2'), ('a', '1')], stdout)
+        {
+          "a": "1",
+          "b": "2"
+        }
+        '''
+        items = sorted(items)
+
+        if not items:
+            outfile.write("{}")
+            return
+
+        outfile.write("{\n")
+
+        for index, (key, value) in enumerate(items):
+            if index:
+                outfile.write(",\n")
+            outfile.write("  %s: %s" % (dumps(key), dumps(value)))
+
+        outfile.write("\n}")
+
+    class JSONSerializer(Serializer):
 
         @classmethod
-        def serialize(cls, items, _):
-            return dumps(items, sort_keys=True, indent=2)
+        def dump(cls, items, _, outfile):
+            dump_json_object(items, outfile)
 
         @classmethod
         def deserialize(cls, string):
@@ -48,13 +111,13 @@ if loads and dumps:
 
     SERIALIZERS['json'] = JSONSerializer
 
-    class JSONPSerializer(object):
+    class JSONPSerializer(Serializer):
 
         @classmethod
-        def serialize(cls, items, map_name):
-            return "%(map_name)s(%(dump)s);" % {
-                'map_name': map_name,
-                'dump': dumps(items, sort_keys=True, indent=2)}
+        def dump(cls, items, map_name, outfile):
+            outfile.write("%s(" % map_name)
+            dump_json_object(items, outfile)
+            outfile.write(");")
 
         @classmethod
         def deserialize(cls, string):
@@ -62,14 +125,13 @@ if loads and dumps:
 
     SERIALIZERS['jsonp'] = JSONPSerializer
 
-    class JavaScriptSerializer(object):
+    class JavaScriptSerializer(Serializer):
 
         @classmethod
-        def serialize(cls, items, map_name):
-            return (
-                "var %s = " % map_name
-                + dumps(items, sort_keys=True, indent=2)
-                + ";")
+        def dump(cls, items, map_name, outfile):
+            outfile.write("var %s = " % map_name)
+            dump_json_object(items, outfile)
+            outfile.write(";")
 
         @classmethod
         def deserialize(cls, string):
@@ -78,19 +140,17 @@ if loads and dumps:
     SERIALIZERS['js'] = JavaScriptSerializer
 
 
-class PreambleEntryEpiloqueSerializer(object):  # pylint: disable=R0903
+class PreambleEntryEpiloqueSerializer(Serializer):  # pylint: disable=R0903
     PREAMBLE = ''
     ENTRY = ''
     EPILOQUE = ''
 
     @classmethod
-    def serialize(cls, items, map_name):
-        return (
-            (cls.PREAMBLE % map_name) + "".join([
-                cls.ENTRY % item
-                for item
-                in list(items.items())]) +
-            cls.EPILOQUE)
+    def dump(cls, items, map_name, outfile):
+        outfile.write(cls.PREAMBLE % map_name)
+        for item in items:
+            outfile.write(cls.ENTRY % item)
+        outfile.write(cls.EPILOQUE)
 
 
 class SassSerializer(PreambleEntryEpiloqueSerializer):
@@ -136,7 +196,7 @@ class PHPSerializer(PreambleEntryEpiloqueSerializer):
 SERIALIZERS['php'] = PHPSerializer
 
 
-class SedSerializer(object):
+class SedSerializer(Serializer):
 
     '''
     Writes a sed script, use like this:
@@ -159,12 +219,16 @@ class SedSerializer(object):
         return filename
 
     @classmethod
-    def serialize(cls, items, _):
-        return "\n".join([
-            (cls.ENTRY % (cls._escape_filename(key),
-                          cls._escape_filename(value)))
-            for key, value
-            in list(items.items())]) + '\n'
+    def dump(cls, items, _, outfile):
+        empty = True
+        for key, value in items:
+            outfile.write(cls.ENTRY % (cls._escape_filename(key),
+                                       cls._escape_filename(value)))
+            outfile.write('\n')
+            empty = False
+
+        if empty:
+            outfile.write('\n')
 
     @classmethod
     def deserialize(cls, string):
@@ -180,3 +244,155 @@ class SedSerializer(object):
         return result
 
 SERIALIZERS['sed'] = SedSerializer
+
+
+class IndexedMap(object):
+
+    '''
+    Looks up entries in a map written by the ``IndexSerializer`` without
+    parsing all of it. Lookups are a binary search over the memory-mapped
+    file:
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> tmp = NamedTemporaryFile(suffix='.idx')
+    >>> IndexSerializer.dump([('b.txt', 'B.txt'), ('a.txt', 'A.txt')], None, tmp)
+    >>> tmp.flush()
+    >>> indexed = IndexedMap.open(tmp.name)
+    >>> len(indexed)
+    2
+    >>> indexed['a.txt']
+    'A.txt'
+    >>> indexed.get('c.txt', 'not found')
+    'not found'
+    >>> 'b.txt' in indexed
+    True
+    >>> list(indexed.items())
+    [('a.txt', 'A.txt'), ('b.txt', 'B.txt')]
+    >>> indexed.close()
+    '''
+
+    def __init__(self, data, close=None):
+        if data[:len(IndexSerializer.MAGIC)] != IndexSerializer.MAGIC:
+            raise ValueError("Not an index map")
+
+        self._data = data
+        self._close = close
+        self._length, = IndexSerializer.COUNT.unpack_from(data, len(IndexSerializer.MAGIC))
+        self._offsets = len(IndexSerializer.MAGIC) + IndexSerializer.COUNT.size
+        self._entries = self._offsets + (self._length + 1) * IndexSerializer.OFFSET.size
+
+    @classmethod
+    def open(cls, filename):
+        infile = open(filename, 'rb')
+        try:
+            data = mmap(infile.fileno(), 0, access=ACCESS_READ)
+        finally:
+            infile.close()
+        return cls(data, data.close)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._length
+
+    def _offset(self, index):
+        return IndexSerializer.OFFSET.unpack_from(
+            self._data, self._offsets + index * IndexSerializer.OFFSET.size)[0]
+
+    def _entry(self, index):
+        start = self._entries + self._offset(index)
+        end = self._entries + self._offset(index + 1)
+        key, value = self._data[start:end].split(b'\0', 1)
+        return key, value
+
+    def _key(self, index):
+        return self._entry(index)[0]
+
+    def __getitem__(self, key):
+        encoded = key.encode('utf-8')
+
+        # like bisect_left, but on the keys in the file
+        low, high = 0, self._length
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._length:
+            found, value = self._entry(low)
+            if found == encoded:
+                return value.decode('utf-8')
+
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def items(self):
+        for index in range(self._length):
+            key, value = self._entry(index)
+            yield key.decode('utf-8'), value.decode('utf-8')
+
+
+class IndexSerializer(Serializer):
+
+    '''
+    Writes a binary map sorted by filename, so lookups don't need to parse
+    the whole map (see ``IndexedMap``). All numbers are little endian::
+
+        magic       8 bytes "HAIDX\\0\\0\\1"
+        count       uint64, number of entries
+        offsets     (count + 1) * uint64, start of every entry relative to
+                    the first entry, followed by the end of the last one
+        entries     "<filename>\\0<hashed filename>", UTF-8 encoded
+    '''
+
+    BINARY = True
+
+    MAGIC = b'HAIDX\0\0\1'
+    COUNT = Struct('<Q')
+    OFFSET = Struct('<Q')
+
+    @classmethod
+    def dump(cls, items, _, outfile):
+        entries = sorted(
+            (key.encode('utf-8'), value.encode('utf-8'))
+            for key, value in items)
+
+        outfile.write(cls.MAGIC)
+        outfile.write(cls.COUNT.pack(len(entries)))
+
+        offset = 0
+        outfile.write(cls.OFFSET.pack(offset))
+        for key, value in entries:
+            offset += len(key) + 1 + len(value)
+            outfile.write(cls.OFFSET.pack(offset))
+
+        for key, value in entries:
+            outfile.write(key + b'\0' + value)
+
+    @classmethod
+    def deserialize(cls, string):
+        return dict(IndexedMap(string).items())
+
+SERIALIZERS['idx'] = IndexSerializer
@@ -0,0 +1,149 @@
+
+'''
+Splits the work of hashing a big tree over several processes or machines.
+
+Every shard processes the files whose name hashes to it and writes a partial
+map. The partition only depends on the names of the files, so every shard
+computes it on its own:
+
+>>> files = ['a.css', 'b.css', 'c.js', 'd.png', 'e.png']
+>>> shards = [[f for f in files if in_shard(f, index, 2)] for index in (1, 2)]
+>>> shards
+[['e.png'], ['a.css', 'b.css', 'c.js', 'd.png']]
+
+The partial maps are merged into the final map. Every partial map is read as
+a sorted stream of entries, which are merged without building the final map
+in memory:
+
+>>> list(merge_items([[('a.css', 'A.css'), ('c.js', 'C.js')],
+...                   [('b.css', 'B.css'), ('c.js', 'C.js')]]))
+[('a.css', 'A.css'), ('b.css', 'B.css'), ('c.js', 'C.js')]
+
+A file that got different names in different maps is a conflict:
+
+>>> list(merge_items([[('a.css', 'A.css')], [('a.css', 'X.css')]]))
+Traceback (most recent call last):
+    ...
+ValueError: Conflicting entries for 'a.css': 'A.css' and 'X.css'
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.shard")
+
+import sys
+from hashlib import md5
+from heapq import merge
+from os.path import splitext
+from struct import unpack_from
+
+from hashedassets.atomic import atomic_write
+from hashedassets.serializer import SERIALIZERS, IndexedMap, IndexSerializer
+
+
+def parse_shard(string):
+    '''
+    Parses a shard given as ``INDEX/COUNT``, counting from 1:
+
+    >>> parse_shard('2/4')
+    (2, 4)
+    >>> parse_shard('5/4')
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid shard '5/4', needs to be INDEX/COUNT with 1 <= INDEX <= COUNT
+    '''
+    try:
+        index, count = [int(part) for part in string.split('/')]
+    except ValueError:
+        index, count = 0, 0
+
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard '%s', needs to be INDEX/COUNT with "
+                         "1 <= INDEX <= COUNT" % string)
+
+    return index, count
+
+
+def in_shard(filename, index, count):
+    '''
+    Whether ``filename`` belongs to shard ``index`` of ``count``. md5 is the
+    same on every platform and Python version, unlike ``hash()``, and spreads
+    similar names evenly, unlike crc32.
+    '''
+    digest = md5(filename.encode('utf-8')).digest()
+    return unpack_from('<Q', digest)[0] % count == index - 1
+
+
+def read_items(filename, format=None):
+    '''
+    Yields the entries of the map ``filename`` sorted by filename. Index
+    maps are sorted already and streamed from disk, other maps need to be
+    parsed first.
+    '''
+    format = format or splitext(filename)[1].lstrip('.')
+    serializer = SERIALIZERS[format]
+
+    if serializer is IndexSerializer:
+        indexed = IndexedMap.open(filename)
+        try:
+            for item in indexed.items():
+                yield item
+        finally:
+            indexed.close()
+        return
+
+    infile = open(filename, 'rb' if serializer.BINARY else 'r')
+    try:
+        content = infile.read()
+    finally:
+        infile.close()
+
+    for item in sorted(serializer.deserialize(content).items()):
+        yield item
+
+
+def merge_items(streams):
+    '''
+    Merges sorted streams of entries into one sorted stream. Raises a
+    ValueError if a file has different names in different streams.
+    '''
+    last = None
+
+    for filename, hashed_filename in merge(*streams):
+        if last is not None and last[0] == filename:
+            if last[1] != hashed_filename:
+                raise ValueError("Conflicting entries for '%s': '%s' and '%s'"
+                                 % (filename, last[1], hashed_filename))
+            continue
+
+        last = (filename, hashed_filename)
+        yield last
+
+
+def merge_maps(filenames, output, format, map_name, input_format=None):
+    '''
+    Merges the partial maps ``filenames`` into the map ``output`` ('-' for
+    stdout). Returns the number of entries.
+    '''
+    serializer = SERIALIZERS[format]
+    merged = [0]
+
+    def counted(items):
+        for item in items:
+            merged[0] += 1
+            yield item
+
+    items = counted(merge_items(
+        [read_items(filename, input_format) for filename in filenames]))
+
+    if output == '-':
+        outfile = sys.stdout
+        if serializer.BINARY:
+            outfile = getattr(sys.stdout, 'buffer', sys.stdout)
+        serializer.dump(items, map_name, outfile)
+    else:
+        # a failed merge keeps the previous map
+        with atomic_write(output, 'wb' if serializer.BINARY else 'w') as outfile:
+            serializer.dump(items, map_name, outfile)
+
+    logger.info("Merged %d entries of %d maps into '%s'", merged[0], len(filenames), output)
+    return merged[0]
@@ -0,0 +1,225 @@
+
+'''
+Hooks get told what an ``AssetHasher`` is doing. ``Hooks`` does nothing and
+is meant to be subclassed, ``Stats`` collects timings and counts and reports
+them at the end of a run.
+
+Phases are timed by wall clock. ``hash``, ``copy`` and ``compress`` are the sums of the
+time spent hashing, copying and compressing the single files, so with
+``--jobs`` they can take longer than the ``process`` phase they are part of.
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.stats")
+
+import sys
+from heapq import heappush, heappushpop
+from threading import Lock
+
+try:
+    from json import dumps
+except ImportError:
+    from simplejson import dumps
+
+try:
+    # Python 2.7
+    from collections import OrderedDict  # pylint: disable=E0611
+except ImportError:
+    try:
+        # Python 2.6
+        from odict import odict as OrderedDict
+    except ImportError:
+        pass
+
+
+class Hooks(object):
+    '''
+    Receives events from an ``AssetHasher``. Hooks may be called from
+    several threads at once.
+    '''
+
+    def phase(self, name, seconds):
+        ''' The phase ``name`` took ``seconds`` '''
+
+    def file_hashed(self, filename, seconds, size):
+        ''' ``filename`` was read and hashed '''
+
+    def file_cached(self, filename):
+        ''' The hash of ``filename`` was found in the cache '''
+
+    def file_skipped(self, filename):
+        ''' The output file of ``filename`` is up to date '''
+
+    def file_copied(self, filename, seconds, size):
+        ''' The output file of ``filename`` was written or linked '''
+
+    def file_removed(self, outfile):
+        ''' An outdated output file was removed '''
+
+    def file_deduplicated(self, filename, size):
+        ''' ``filename`` was linked to a file with the same content '''
+
+    def file_compressed(self, outfile, seconds, size):
+        ''' Compressed sidecars of ``size`` bytes were written for ``outfile`` '''
+
+    def file_processed(self, filename, seconds):
+        ''' ``filename`` was done after ``seconds`` '''
+
+    def finished(self):
+        ''' The run is over '''
+
+
+class Stats(Hooks):
+    '''
+    Collects timings and counts and writes them to ``output`` when the run
+    is finished.
+
+    >>> from io import StringIO
+    >>> output = StringIO()
+    >>> stats = Stats(output, format='human', slowest=1)
+    >>> stats.phase('discover', 0.25)
+    >>> stats.file_hashed('foo.txt', 0.5, 2048)
+    >>> stats.file_copied('foo.txt', 0.125, 2048)
+    >>> stats.file_processed('foo.txt', 0.625)
+    >>> stats.file_cached('bar.txt')
+    >>> stats.file_skipped('bar.txt')
+    >>> stats.file_processed('bar.txt', 0.001)
+    >>> stats.finished()
+    >>> print(output.getvalue().rstrip())
+    Phases:
+      discover       0.250s
+      hash           0.500s  4.0 KiB/s
+      copy           0.125s  16.0 KiB/s
+    Files: 1 hashed, 1 cached, 1 skipped, 1 copied, 0 removed, 0 deduplicated
+    Bytes: 2048 read, 2048 written, 0 saved
+    Slowest files:
+      0.625s  foo.txt
+
+    >>> stats.summary()['files']['hashed']
+    1
+    '''
+
+    PHASES = ('discover', 'read', 'process', 'hash', 'copy', 'compress', 'gc', 'write')
+    COUNTS = ('hashed', 'cached', 'skipped', 'copied', 'removed', 'deduplicated')
+
+    def __init__(self, output=None, format='human', slowest=10):
+        self.output = output
+        self.format = format
+        self.slowest = slowest
+        self._lock = Lock()
+        self._phases = OrderedDict()
+        self._counts = OrderedDict((name, 0) for name in self.COUNTS)
+        self._bytes = OrderedDict((('read', 0), ('written', 0), ('saved', 0)))
+        self._slowest = []  # heap of (seconds, filename)
+
+    def _add_phase(self, name, seconds):
+        self._phases[name] = self._phases.get(name, 0) + seconds
+
+    def phase(self, name, seconds):
+        with self._lock:
+            self._add_phase(name, seconds)
+
+    def file_hashed(self, filename, seconds, size):
+        with self._lock:
+            self._add_phase('hash', seconds)
+            self._counts['hashed'] += 1
+            self._bytes['read'] += size
+
+    def file_cached(self, filename):
+        with self._lock:
+            self._counts['cached'] += 1
+
+    def file_skipped(self, filename):
+        with self._lock:
+            self._counts['skipped'] += 1
+
+    def file_copied(self, filename, seconds, size):
+        with self._lock:
+            self._add_phase('copy', seconds)
+            self._counts['copied'] += 1
+            self._bytes['written'] += size
+
+    def file_removed(self, outfile):
+        with self._lock:
+            self._counts['removed'] += 1
+
+    def file_deduplicated(self, filename, size):
+        with self._lock:
+            self._counts['deduplicated'] += 1
+            self._bytes['saved'] += size
+
+    def file_compressed(self, outfile, seconds, size):
+        with self._lock:
+            self._add_phase('compress', seconds)
+            self._bytes['written'] += size
+
+    def file_processed(self, filename, seconds):
+        if not self.slowest:
+            return
+
+        with self._lock:
+            if len(self._slowest) < self.slowest:
+                heappush(self._slowest, (seconds, filename))
+            else:
+                heappushpop(self._slowest, (seconds, filename))
+
+    def summary(self):
+        with self._lock:
+            phases = OrderedDict(
+                (name, self._phases[name])
+                for name in self.PHASES
+                if name in self._phases)
+            return OrderedDict((
+                ('phases', phases),
+                ('files', OrderedDict(self._counts)),
+                ('bytes', OrderedDict(self._bytes)),
+                ('slowest', [[filename, seconds] for seconds, filename
+                             in sorted(self._slowest, reverse=True)]),
+            ))
+
+    @staticmethod
+    def _rate(size, seconds):
+        if not seconds:
+            return ''
+
+        rate = size / seconds
+        for unit in ('B', 'KiB', 'MiB', 'GiB'):
+            if rate < 1024:
+                break
+            rate /= 1024.0
+
+        return '  %.1f %s/s' % (rate, unit)
+
+    def format_human(self):
+        summary = self.summary()
+        lines = ['Phases:']
+
+        for name, seconds in summary['phases'].items():
+            rate = ''
+            if name == 'hash':
+                rate = self._rate(summary['bytes']['read'], seconds)
+            elif name == 'copy':
+                rate = self._rate(summary['bytes']['written'], seconds)
+            lines.append('  %-12s %7.3fs%s' % (name, seconds, rate))
+
+        lines.append('Files: ' + ', '.join(
+            '%d %s' % (count, name) for name, count in summary['files'].items()))
+        lines.append('Bytes: %(read)d read, %(written)d written, %(saved)d saved'
+                     % summary['bytes'])
+
+        if summary['slowest']:
+            lines.append('Slowest files:')
+            for filename, seconds in summary['slowest']:
+                lines.append('  %.3fs  %s' % (seconds, filename))
+
+        return '\n'.join(lines)
+
+    def format_json(self):
+        return dumps(self.summary(), indent=2)
+
+    def finished(self):
+        output = self.output or sys.stderr
+        if self.format == 'json':
+            output.write(self.format_json() + '\n')
+        else:
+            output.write(self.format_human() + '\n')
@@ -80,6 +80,19 @@ def test_suite():
         doctest.DocTestSuite('hashedassets'),
         doctest.DocTestSuite('hashedassets.rewrite'),
         doctest.DocTestSuite('hashedassets.serializer'),
+        doctest.DocTestSuite('hashedassets.cache'),
+        doctest.DocTestSuite('hashedassets.map'),
+        doctest.DocTestSuite('hashedassets.watch'),
+        doctest.DocTestSuite('hashedassets.stats'),
+        doctest.DocTestSuite('hashedassets.compress'),
+        doctest.DocTestSuite('hashedassets.references'),
+        doctest.DocTestSuite('hashedassets.garbage'),
+        doctest.DocTestSuite('hashedassets.bench'),
+        doctest.DocTestSuite('hashedassets.aio'),
+        doctest.DocTestSuite('hashedassets.shard'),
+        doctest.DocTestSuite('hashedassets.atomic'),
+        doctest.DocTestSuite('hashedassets.journal'),
+        doctest.DocTestSuite('hashedassets.compact'),
 
         doctest.DocFileSuite(join(dirname(abspath(__file__)), 'hashedassets.rst'), **opts),
         doctest.DocFileSuite(join(dirname(abspath(__file__)), 'errors.rst'), **opts),
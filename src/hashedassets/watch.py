@@ -0,0 +1,259 @@
+
+'''
+Watchers report which paths below a set of directories changed.
+
+``InotifyWatcher`` asks the linux kernel to tell us about changes, the
+``PollingWatcher`` works everywhere, but needs to stat every file regularly.
+'''
+
+import logging
+logger = logging.getLogger("hashedassets.watch")
+
+import ctypes
+import os
+import struct
+from ctypes.util import find_library
+from errno import EINTR
+from os.path import join, isdir
+from select import select
+from time import sleep, time
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    from scandir import scandir
+
+from hashedassets.cache import stat_signature
+
+
+class PollingWatcher(object):
+    '''
+    Finds changes by comparing the stat results of all files every
+    ``interval`` seconds:
+
+    >>> from tempfile import mkdtemp
+    >>> root = mkdtemp()
+    >>> watcher = PollingWatcher([root], interval=0.01)
+    >>> open(join(root, 'new.txt'), 'w').close()
+    >>> watcher.read(1) == set([join(root, 'new.txt')])
+    True
+    >>> watcher.read(0.05)
+    set()
+    >>> os.remove(join(root, 'new.txt'))
+    >>> watcher.read(1) == set([join(root, 'new.txt')])
+    True
+    >>> os.rmdir(root)
+    '''
+
+    def __init__(self, roots, interval=0.5):
+        self.roots = roots
+        self.interval = interval
+        self._snapshot = self.snapshot()
+
+    def snapshot(self):
+        result = {}
+        stack = list(self.roots)
+
+        while stack:
+            path = stack.pop()
+            try:
+                entries = list(scandir(path))
+            except OSError:
+                continue
+
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        result[entry.path] = stat_signature(entry.stat())
+                except OSError:
+                    # vanished in between
+                    continue
+
+        return result
+
+    def read(self, timeout=None):
+        '''
+        Waits up to ``timeout`` seconds (forever if None) for changes and
+        returns the set of changed paths.
+        '''
+        deadline = None if timeout is None else time() + timeout
+
+        while True:
+            if deadline is None:
+                sleep(self.interval)
+            else:
+                sleep(max(0, min(self.interval, deadline - time())))
+
+            snapshot = self.snapshot()
+            changed = set(
+                path
+                for path in set(snapshot) | set(self._snapshot)
+                if snapshot.get(path) != self._snapshot.get(path))
+            self._snapshot = snapshot
+
+            if changed or (deadline is not None and time() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    '''
+    Uses linux' inotify to get notified about changes:
+
+    >>> from tempfile import mkdtemp
+    >>> root = mkdtemp()
+    >>> watcher = InotifyWatcher([root])
+    >>> os.mkdir(join(root, 'subdir'))
+    >>> sorted(watcher.read(1)) == [join(root, 'subdir')]
+    True
+    >>> open(join(root, 'subdir', 'new.txt'), 'w').close()
+    >>> sorted(watcher.read(1)) == [join(root, 'subdir', 'new.txt')]
+    True
+    >>> watcher.read(0.05)
+    set()
+    >>> watcher.close()
+    >>> from shutil import rmtree
+    >>> rmtree(root)
+    '''
+
+    # from linux/inotify.h
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, roots):
+        self.roots = roots
+        self._libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._paths = {}
+
+        for root in roots:
+            self.add_watches(root)
+
+    def add_watches(self, top):
+        ''' Watches ``top`` and all directories below it '''
+        stack = [top]
+
+        while stack:
+            path = stack.pop()
+            wd = self._libc.inotify_add_watch(
+                self._fd, path.encode(), self.MASK)
+            if wd < 0:
+                logger.debug("Can't watch '%s'", path)
+                continue
+            self._paths[wd] = path
+
+            try:
+                entries = list(scandir(path))
+            except OSError:
+                continue
+
+            stack.extend(
+                entry.path
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False))
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == EINTR:
+                return
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            yield wd, mask, name
+
+    def read(self, timeout=None):
+        '''
+        Waits up to ``timeout`` seconds (forever if None) for changes and
+        returns the set of changed paths.
+        '''
+        changed = set()
+        deadline = None if timeout is None else time() + timeout
+
+        while not changed:
+            remaining = None if deadline is None else max(0, deadline - time())
+            readable, _, _ = select([self._fd], [], [], remaining)
+            if not readable:
+                break
+
+            for wd, mask, name in self._read_events():
+                if mask & self.IN_Q_OVERFLOW:
+                    logger.warning("Missed some changes, looking at everything")
+                    changed.update(self.roots)
+                    continue
+
+                if mask & self.IN_IGNORED:
+                    self._paths.pop(wd, None)
+                    continue
+
+                if wd not in self._paths or mask & self.IN_DELETE_SELF:
+                    continue
+
+                path = join(self._paths[wd], name)
+                changed.add(path)
+
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.add_watches(path)
+
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def create_watcher(roots, interval=0.5):
+    '''
+    Returns an ``InotifyWatcher`` if possible, a ``PollingWatcher``
+    otherwise.
+    '''
+    roots = [root for root in roots if isdir(root)]
+    try:
+        return InotifyWatcher(roots)
+    except (AttributeError, OSError) as e:
+        logger.debug("Can't use inotify, polling instead", exc_info=e)
+        return PollingWatcher(roots, interval)
+
+
+def batches(watcher, debounce=0.1):
+    '''
+    Yields sets of changed paths. Changes that happen less than ``debounce``
+    seconds apart are reported together.
+    '''
+    while True:
+        changed = watcher.read()
+
+        while True:
+            more = watcher.read(debounce)
+            if not more:
+                break
+            changed |= more
+
+        yield changed